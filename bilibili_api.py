@@ -1,7 +1,19 @@
 import os
 import time
-import json
+import hashlib
 import requests
+from urllib.parse import urlencode
+from config import load_config
+from credentials import credentials
+from tracing import traced
+
+# WBI签名使用的字符重排表
+MIXIN_KEY_ENC_TAB = [
+    46, 47, 18, 2, 53, 8, 23, 32, 15, 50, 10, 31, 58, 3, 45, 35, 27, 43, 5, 49,
+    33, 9, 42, 19, 29, 28, 14, 39, 12, 38, 41, 13, 37, 48, 7, 16, 24, 55, 40,
+    61, 26, 17, 0, 1, 60, 51, 30, 4, 22, 25, 54, 21, 56, 59, 6, 63, 57, 62, 11,
+    36, 20, 34, 44, 52
+]
 
 class BilibiliAPI:
     def __init__(self):
@@ -9,41 +21,38 @@ class BilibiliAPI:
             'referer': 'https://www.bilibili.com/',
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
         }
+        # 复用连接，并发预取时避免每个请求都重新握手
+        self.session = requests.Session()
+        # (连接超时, 读取超时)，避免接口无响应时一直等待
+        settings = load_config()['api']
+        self.timeout = (settings['connect_timeout'], settings['read_timeout'])
+        self.wbi_key = None
+        self.wbi_key_time = 0
         # 初始化时加载cookie
         self.load_cookies()
 
     def load_cookies(self):
-        """加载保存的cookie"""
-        try:
-            if os.path.exists('bili_cookies.json'):
-                with open('bili_cookies.json', 'r', encoding='utf-8') as f:
-                    cookies = json.load(f)
-                    # 将cookie字典转换为字符串格式
-                    cookie_string = '; '.join([f'{k}={v}' for k, v in cookies.items()])
-                    self.headers['Cookie'] = cookie_string
-                return True
-            else:
-                print("Cookie文件不存在")
-                return False
-        except Exception as e:
-            print(f"加载cookie失败: {str(e)}")
-            return False
+        """加载保存的cookie，之后登录状态变化时会自动更新"""
+        if credentials.bind(self):
+            return True
+        print("Cookie文件不存在")
+        return False
 
     def update_cookies(self, cookie_dict):
-        """更新cookie"""
+        """更新cookie（同时更新所有共享凭据的对象）"""
         try:
-            cookie_string = '; '.join([f'{k}={v}' for k, v in cookie_dict.items()])
-            self.headers['Cookie'] = cookie_string
+            credentials.update(cookie_dict)
             return True
         except Exception as e:
             print(f"更新cookie失败: {str(e)}")
             return False
 
+    @traced('api.get_video_info')
     def get_video_info(self, bv_number):
         """获取视频信息"""
         try:
             meta_url = f"https://api.bilibili.com/x/web-interface/view?bvid={bv_number}"
-            response = requests.get(meta_url, headers=self.headers)
+            response = self.session.get(meta_url, headers=self.headers, timeout=self.timeout)
 
             if response.status_code != 200:
                 return None, f"请求失败，状态码: {response.status_code}"
@@ -69,11 +78,12 @@ class BilibiliAPI:
         except Exception as e:
             return None, f"程序出错: {str(e)}"
 
+    @traced('api.get_download_urls')
     def get_download_urls(self, aid, cid, quality):
         """获取下载链接"""
         try:
             download_url = f"https://api.bilibili.com/x/player/playurl?avid={aid}&cid={cid}&qn={quality}&fnver=0&fnval=80&fourk=1"
-            response = requests.get(download_url, headers=self.headers)
+            response = self.session.get(download_url, headers=self.headers, timeout=self.timeout)
 
             if response.status_code != 200:
                 return None, f'获取下载链接失败，状态码：{response.status_code}'
@@ -92,14 +102,63 @@ class BilibiliAPI:
             if 'dash' not in download_data.get('data', {}):
                 return None, '视频格式不支持'
 
-            video_url = download_data['data']['dash']['video'][0]['baseUrl']
-            audio_url = download_data['data']['dash']['audio'][0]['baseUrl']
+            dash = download_data['data']['dash']
+            video_stream = dash['video'][0]
+            audio_stream = dash['audio'][0]
 
-            return {'video_url': video_url, 'audio_url': audio_url}, None
+            return {
+                       'video_url': video_stream['baseUrl'],
+                       'audio_url': audio_stream['baseUrl'],
+                       # 完整的DASH流信息（含 segment_base 索引范围、码率等），供片段下载使用
+                       'video_stream': video_stream,
+                       'audio_stream': audio_stream,
+                       # 所有清晰度和编码的流，刷新地址时从中找回原来的那一路
+                       'video_streams': dash['video'],
+                       'audio_streams': dash['audio'],
+                       'duration': dash.get('duration', 0)
+                   }, None
 
         except Exception as e:
             return None, f"获取下载链接出错: {str(e)}"
 
+    @traced('api.get_danmaku_segment')
+    def get_danmaku_segment(self, aid, cid, index):
+        """请求一段（6分钟）弹幕，返回 (流式响应, error)，调用方负责关闭响应"""
+        try:
+            response = self.session.get(
+                "https://api.bilibili.com/x/v2/dm/web/seg.so",
+                params={'type': 1, 'oid': cid, 'pid': aid, 'segment_index': index},
+                headers=self.headers, timeout=self.timeout, stream=True
+            )
+            if response.status_code != 200:
+                response.close()
+                return None, f"获取弹幕失败，状态码: {response.status_code}"
+            return response, None
+        except requests.exceptions.RequestException as e:
+            return None, f"网络请求失败: {str(e)}"
+
+    def get_subtitles(self, aid, cid):
+        """获取CC字幕列表，返回 ([{lan, lan_doc, subtitle_url}], error)"""
+        data, error = self.get_json("https://api.bilibili.com/x/player/wbi/v2", {'aid': aid, 'cid': cid}, wbi=True)
+        if error:
+            return None, error
+        return (data.get('subtitle') or {}).get('subtitles') or [], None
+
+    @traced('api.get_subtitle_body')
+    def get_subtitle_body(self, url):
+        """下载字幕内容，返回 ([{from, to, content}], error)"""
+        try:
+            if url.startswith('//'):
+                url = 'https:' + url
+            response = self.session.get(url, headers=self.headers, timeout=self.timeout)
+            if response.status_code != 200:
+                return None, f"请求失败，状态码: {response.status_code}"
+            return response.json().get('body', []), None
+        except requests.exceptions.RequestException as e:
+            return None, f"网络请求失败: {str(e)}"
+        except ValueError:
+            return None, "字幕解析失败"
+
     def prepare_download_paths(self, download_path, title):
         """准备下载路径"""
         try:
@@ -131,7 +190,7 @@ class BilibiliAPI:
         try:
             # 尝试访问需要登录的API接口
             test_url = "https://api.bilibili.com/x/web-interface/nav"
-            response = requests.get(test_url, headers=self.headers)
+            response = self.session.get(test_url, headers=self.headers, timeout=self.timeout)
             data = response.json()
 
             if data['code'] == 0:
@@ -139,4 +198,61 @@ class BilibiliAPI:
             else:
                 return False, "Cookie已过期或无效"
         except Exception as e:
-            return False, f"检查Cookie状态失败: {str(e)}"
\ No newline at end of file
+            return False, f"检查Cookie状态失败: {str(e)}"
+
+    @traced('api.get_wbi_key')
+    def get_wbi_key(self):
+        """获取WBI签名密钥，每小时刷新一次"""
+        if self.wbi_key and time.time() - self.wbi_key_time < 3600:
+            return self.wbi_key
+        nav_url = "https://api.bilibili.com/x/web-interface/nav"
+        response = self.session.get(nav_url, headers=self.headers, timeout=self.timeout)
+        # 未登录时 code 为 -101，但仍然会返回 wbi_img
+        wbi_img = response.json()['data']['wbi_img']
+        img_key = wbi_img['img_url'].rsplit('/', 1)[-1].split('.')[0]
+        sub_key = wbi_img['sub_url'].rsplit('/', 1)[-1].split('.')[0]
+        raw_key = img_key + sub_key
+        self.wbi_key = ''.join(raw_key[i] for i in MIXIN_KEY_ENC_TAB)[:32]
+        self.wbi_key_time = time.time()
+        return self.wbi_key
+
+    def sign_wbi_params(self, params):
+        """为请求参数添加WBI签名（wts 和 w_rid）"""
+        params = dict(params)
+        params['wts'] = int(time.time())
+        # 参数按键名排序，并过滤值中的 !'()* 字符
+        params = {
+            k: ''.join(c for c in str(v) if c not in "!'()*")
+            for k, v in sorted(params.items())
+        }
+        query = urlencode(params)
+        params['w_rid'] = hashlib.md5((query + self.get_wbi_key()).encode()).hexdigest()
+        return params
+
+    @traced('api.get_json')
+    def get_json(self, url, params=None, wbi=False):
+        """请求返回JSON的接口，返回 (data, error)"""
+        try:
+            if wbi:
+                params = self.sign_wbi_params(params or {})
+            response = self.session.get(url, params=params, headers=self.headers, timeout=self.timeout)
+
+            if response.status_code != 200:
+                return None, f"请求失败，状态码: {response.status_code}"
+
+            try:
+                data = response.json()
+            except ValueError:
+                return None, f"JSON解析失败: {response.text[:100]}"
+
+            if data.get('code') == 0:
+                return data.get('data'), None
+            elif data.get('code') == -403:
+                return None, "Cookie已过期，请重新登录"
+            else:
+                return None, f"请求失败: {data.get('message', '未知错误')}"
+
+        except requests.exceptions.RequestException as e:
+            return None, f"网络请求失败: {str(e)}"
+        except Exception as e:
+            return None, f"程序出错: {str(e)}"
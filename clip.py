@@ -0,0 +1,211 @@
+import os
+import struct
+import time
+import requests
+
+from download import DownloadWorker, content_range_total
+from memory import get_buffer_pool
+from process import merge_clip
+from scheduler import get_scheduler
+
+
+def parse_time(text):
+    """解析时间字符串，支持 秒 / 分:秒 / 时:分:秒"""
+    seconds = 0.0
+    for part in text.strip().split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def parse_range(text):
+    """解析 '0-1030' 形式的字节范围"""
+    start, end = text.split('-')
+    return int(start), int(end)
+
+
+def get_segment_base(stream):
+    """从DASH流信息中取出初始化段和索引段的字节范围"""
+    segment_base = stream.get('segment_base') or {}
+    initialization = segment_base.get('initialization')
+    index_range = segment_base.get('index_range')
+    if not initialization or not index_range:
+        segment_base = stream.get('SegmentBase') or {}
+        initialization = segment_base.get('Initialization')
+        index_range = segment_base.get('indexRange')
+    if not initialization or not index_range:
+        return None
+    return parse_range(initialization), parse_range(index_range)
+
+
+def parse_sidx(data, sidx_offset):
+    """解析sidx盒子，返回每个分片的 (起始字节, 结束字节, 起始秒, 结束秒)
+
+    sidx_offset 是sidx盒子在文件中的起始位置，分片偏移以盒子末尾为基准。
+    """
+    box_size, box_type = struct.unpack('>I4s', data[:8])
+    if box_type != b'sidx':
+        raise ValueError('索引段不是sidx盒子')
+    version = data[8]
+    pos = 12 + 4  # 跳过 version/flags 和 reference_ID
+    timescale, = struct.unpack('>I', data[pos:pos + 4])
+    pos += 4
+    if version == 0:
+        earliest_time, first_offset = struct.unpack('>II', data[pos:pos + 8])
+        pos += 8
+    else:
+        earliest_time, first_offset = struct.unpack('>QQ', data[pos:pos + 16])
+        pos += 16
+    pos += 2  # reserved
+    reference_count, = struct.unpack('>H', data[pos:pos + 2])
+    pos += 2
+
+    fragments = []
+    offset = sidx_offset + box_size + first_offset
+    current_time = earliest_time
+    for _ in range(reference_count):
+        reference, duration = struct.unpack('>II', data[pos:pos + 8])
+        pos += 12  # 跳过 SAP 信息
+        size = reference & 0x7fffffff
+        fragments.append((offset, offset + size - 1, current_time / timescale, (current_time + duration) / timescale))
+        offset += size
+        current_time += duration
+    return fragments
+
+
+def select_fragments(fragments, start, end):
+    """选出覆盖 [start, end) 时间段的连续分片"""
+    selected = [f for f in fragments if f[3] > start and f[2] < end]
+    if not selected:
+        return None
+    return selected[0][0], selected[-1][1], selected[0][2]
+
+
+class ClipWorker(DownloadWorker):
+    """只下载指定时间段所需的分片并合并成独立的MP4"""
+
+    def __init__(self, video_stream, audio_stream, paths, start, end, desc="片段", url_resolvers=None, tracer=None):
+        super().__init__(video_stream['baseUrl'], paths['output_path'], desc, tracer=tracer)
+        self.streams = [("视频", video_stream, paths['video_path']), ("音频", audio_stream, paths['audio_path'])]
+        self.start_time = start
+        self.end_time = end
+        # (视频, 音频) 地址的刷新函数，地址过期返回403时使用
+        self.url_resolvers = dict(zip(("视频", "音频"), url_resolvers or ()))
+        # 各流的文件总大小，字节范围是按原文件的索引算的，换地址后必须是同一个文件
+        self.stream_sizes = {}
+
+    def fetch_range(self, name, stream, first, last):
+        """请求指定字节范围，返回响应；地址过期时刷新后重试一次"""
+        self.headers['Range'] = f'bytes={first}-{last}'
+        with self.tracer.span('connect+ttfb', first=first, last=last) as span:
+            response = self.get_response(stream['baseUrl'])
+            span['status'] = response.status_code
+        if response.status_code == 403 and name in self.url_resolvers:
+            response.close()
+            url, error = self.url_resolvers[name]()
+            if error:
+                raise Exception(f"刷新{name}下载地址失败：{error}")
+            stream['baseUrl'] = url
+            self.status_updated.emit(f"{name}下载地址已刷新")
+            with self.tracer.span('connect+ttfb', first=first, last=last):
+                response = self.get_response(url)
+        if response.status_code == 403:
+            raise Exception("下载地址已失效或无访问权限(HTTP 403)")
+        if response.status_code != 206:
+            raise Exception(f"服务器不支持Range请求：HTTP {response.status_code}")
+        total = content_range_total(response)
+        known = self.stream_sizes.setdefault(name, total)
+        if total and known and total != known:
+            response.close()
+            raise Exception(f"{name}新地址的文件大小与原文件不一致")
+        return response
+
+    def plan_stream(self, name, stream):
+        """读取索引，计算需要下载的字节范围"""
+        segment_base = get_segment_base(stream)
+        if not segment_base:
+            raise Exception("视频流缺少SegmentBase索引，无法按时间截取")
+        (init_start, init_end), (index_start, index_end) = segment_base
+        index_data = self.fetch_range(name, stream, index_start, index_end).content
+        fragments = parse_sidx(index_data, index_start)
+        selected = select_fragments(fragments, self.start_time, self.end_time)
+        if not selected:
+            raise Exception("所选时间段超出视频范围")
+        first, last, fragment_time = selected
+        return [(init_start, init_end), (first, last)], self.start_time - fragment_time
+
+    def run(self):
+        # 和普通下载一样占用一个下载流名额，并从缓冲区池借用缓冲区
+        pool = get_buffer_pool()
+        with self.tracer.activate():
+            with pool.stream_slot(on_wait=lambda: self.status_updated.emit(f"{self.desc}等待内存配额...")):
+                with self.tracer.span(self.desc, save_path=self.save_path):
+                    self.download_clip(pool)
+
+    def download_clip(self, pool):
+        try:
+            plans = []
+            for name, stream, path in self.streams:
+                with self.tracer.span(f"{name}.plan"):
+                    ranges, offset = self.plan_stream(name, stream)
+                plans.append((name, stream, path, ranges, offset))
+
+            total_size = sum(last - first + 1 for plan in plans for first, last in plan[3])
+            self.status_updated.emit(f"片段共需下载 {self.format_size(total_size)}")
+
+            downloaded_size = 0
+            # 所有下载共用的带宽限速，由调度器按时间段调整
+            limiter = get_scheduler().limiter
+            start_time = time.time()
+            transfer_start = self.tracer.now()
+            # 片段按顺序下载，同一时间只需要一个缓冲区
+            buffer = pool.acquire()
+            try:
+                for name, stream, path, ranges, offset in plans:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path, 'wb') as file:
+                        # 只写入初始化段和选中的分片，不带sidx，得到可独立解析的fMP4
+                        for first, last in ranges:
+                            response = self.fetch_range(name, stream, first, last)
+                            try:
+                                while True:
+                                    if not self.is_running:
+                                        self.status_updated.emit(f"{self.desc}下载已取消")
+                                        self.download_completed.emit(False, self.desc)
+                                        return
+                                    size = response.raw.readinto(buffer)
+                                    if not size:
+                                        break
+                                    downloaded_size += file.write(memoryview(buffer)[:size])
+                                    limiter.acquire(size)
+                                    progress = int(downloaded_size / total_size * 100) if total_size > 0 else 0
+                                    elapsed_time = time.time() - start_time
+                                    if elapsed_time > 0:
+                                        speed = downloaded_size / elapsed_time
+                                        self.stats_updated.emit(self.desc, downloaded_size, total_size, speed)
+                                    self.progress_updated.emit(progress, self.desc)
+                            finally:
+                                response.close()
+            finally:
+                pool.release(buffer)
+
+            self.tracer.complete('transfer', transfer_start, bytes=downloaded_size)
+
+            video_offset, audio_offset = plans[0][4], plans[1][4]
+            success, message = merge_clip(
+                plans[0][2], plans[1][2], self.save_path,
+                video_offset, audio_offset, self.end_time - self.start_time
+            )
+            self.status_updated.emit(message)
+            if success:
+                self.status_updated.emit(f"{self.desc}已保存至: {self.save_path}")
+            self.download_completed.emit(success, self.desc)
+
+        except requests.exceptions.RequestException as e:
+            self.status_updated.emit(f"网络错误：{str(e)}")
+            self.download_completed.emit(False, self.desc)
+        except IOError as e:
+            self.status_updated.emit(f"文件写入错误：{str(e)}")
+            self.download_completed.emit(False, self.desc)
+        except Exception as e:
+            self.status_updated.emit(f"下载{self.desc}出错: {str(e)}")
+            self.download_completed.emit(False, self.desc)
@@ -0,0 +1,109 @@
+import copy
+import os
+import json
+
+CONFIG_FILE = 'bili_config.json'
+
+# 默认配置，bili_config.json 中的同名项会覆盖这里的值
+DEFAULT_CONFIG = {
+    'api': {
+        'connect_timeout': 5,  # 连接超时（秒）
+        'read_timeout': 15,  # 读取超时（秒）
+    },
+    'prefetch': {
+        'concurrency': 8,  # 同时解析的BV数量
+        'rate_limit': 10,  # 每秒最多发起的API请求数
+        'quality': 80,  # 预取playurl时使用的画质
+    },
+    'download': {
+        'chunk_size': 1024 * 1024,  # 每次从网络读取的字节数
+        'write_queue_size': 8,  # 等待写盘的数据块上限，满了会让下载线程等待
+        'write_batch_size': 4 * 1024 * 1024,  # 写入线程每批最多合并写入的字节数
+        'max_active_jobs': 3,  # 界面中同时进行的下载任务数，其余任务排队
+        'disk_reserve_mb': 1024,  # 磁盘至少保留的空间，不够时新任务等待
+        'max_disk_wait_minutes': 30,  # 任务等待磁盘空间超过这么久后不再让更小的任务插队
+        'probe_size': False,  # 是否用Range请求探测准确大小，否则按码率估算
+    },
+    'memory': {
+        'budget_mb': 512,  # 下载缓冲区的总内存预算，超出时新的下载流排队等待
+    },
+    'postprocess': {
+        # 下载完成后依次执行的阶段，可选 transcode、loudnorm、thumbnail、extract_audio，为空则不处理
+        'stages': [],
+        'workers': 0,  # 进程数，0表示使用CPU核数
+        'threads_per_job': 1,  # 每个ffmpeg进程的线程数，多个文件并行时避免抢占CPU，0表示自动
+        'transcode': {'video_codec': 'libx264', 'preset': 'medium', 'crf': 23, 'audio_codec': 'aac'},
+        'loudnorm': {'filter': 'loudnorm=I=-16:TP=-1.5:LRA=11'},
+        'thumbnail': {'width': 480},
+    },
+    'output': {
+        'sink': 'local',  # 完成的文件交付到哪里：local、archive、s3
+        'local': {'directory': None},  # 为空则留在下载路径中
+        'archive': {'path': 'bili_archive.zip', 'format': 'zip'},  # format 可选 zip、tar
+        's3': {
+            'endpoint': 'http://127.0.0.1:9000',
+            'bucket': 'bilibili',
+            'access_key': '',
+            'secret_key': '',
+            'region': 'us-east-1',
+            'prefix': '',
+            'part_size': 16 * 1024 * 1024,
+            'concurrency': 4,
+        },
+    },
+    'schedule': {
+        # 允许下载的时间段及限速(MB/s，0为不限速)，为空则随时下载，例如：
+        # [{'start': '01:00', 'end': '07:00', 'rate_limit_mb': 0},
+        #  {'start': '07:00', 'end': '01:00', 'rate_limit_mb': 2}]
+        'windows': [],
+        'deadline': None,  # 队列需要在此时刻（HH:MM）前完成，会按剩余量匀速下载
+        'expected_bandwidth_mb': 10,  # 预估时不限速时段按此速度计算
+    },
+    'danmaku': {
+        'enabled': False,  # 下载视频时同时导出弹幕和CC字幕
+        'formats': ['ass', 'archive'],  # ass：可直接播放的弹幕字幕；archive：紧凑的列式存档(.danmaku.zip)
+        'subtitles': True,  # 导出CC字幕为SRT
+        'ass': {
+            'width': 1920, 'height': 1080,
+            'font': 'Microsoft YaHei', 'font_size': 48,
+            'scroll_duration': 8,  # 滚动弹幕在屏幕上停留的秒数
+            'fixed_duration': 4,  # 顶部、底部弹幕停留的秒数
+            'area': 0.8,  # 弹幕占屏幕高度的比例
+            'opacity': 0.8,
+        },
+    },
+    'tracing': {
+        'enabled': False,  # 为每个任务记录时间线（Chrome trace 格式）
+        'directory': 'traces',  # 时间线文件保存目录
+        'stall_threshold_ms': 500,  # 单次读取、限速或写盘等待超过此时长记为卡顿
+        'profile_after_seconds': 0,  # 任务超过此时长仍未完成时挂上采样分析器，0表示不分析
+        'profile_interval_ms': 10,  # 采样间隔
+    },
+    'sync': {
+        'state_file': 'bili_sync_state.json',  # 记录每个订阅源已同步到的位置
+        'download_concurrency': 2,  # 同步时同时下载的视频数量
+    },
+}
+
+
+def merge_config(defaults, values):
+    """把用户配置逐层合并到默认配置上，返回新的字典，嵌套的配置项也只覆盖用户写了的部分"""
+    merged = copy.deepcopy(defaults)
+    for key, value in values.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def load_config(path=CONFIG_FILE):
+    """加载配置，缺失的项使用默认值"""
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    try:
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                config = merge_config(DEFAULT_CONFIG, json.load(f))
+    except Exception as e:
+        print(f"加载配置失败，使用默认配置: {str(e)}")
+    return config
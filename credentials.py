@@ -0,0 +1,69 @@
+import os
+import json
+import threading
+import weakref
+
+COOKIE_FILE = 'bili_cookies.json'
+
+
+class CredentialStore:
+    """进程内共享的登录凭据
+
+    持有 headers 的对象（BilibiliAPI、DownloadWorker 等）通过 bind 注册，
+    登录成功后直接更新它们的 Cookie，不需要各自重新读取 bili_cookies.json。
+    """
+
+    def __init__(self, path=COOKIE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.cookies = None
+        self.loaded = False
+        self.bound = weakref.WeakSet()
+
+    def load(self):
+        """读取cookie文件，只在第一次调用时读取"""
+        with self.lock:
+            if not self.loaded:
+                self.loaded = True
+                try:
+                    if os.path.exists(self.path):
+                        with open(self.path, 'r', encoding='utf-8') as f:
+                            self.cookies = json.load(f)
+                except Exception as e:
+                    print(f"加载cookie失败: {str(e)}")
+            return self.cookies
+
+    def cookie_string(self):
+        """Cookie 请求头的值，未登录时返回None"""
+        cookies = self.load()
+        if not cookies:
+            return None
+        return '; '.join([f'{k}={v}' for k, v in cookies.items()])
+
+    def bind(self, holder):
+        """注册持有 headers 的对象，立即写入当前Cookie，之后随登录状态更新"""
+        self.bound.add(holder)
+        self.apply(holder)
+        return self.cookies is not None
+
+    def apply(self, holder):
+        cookie_string = self.cookie_string()
+        if cookie_string:
+            holder.headers['Cookie'] = cookie_string
+        else:
+            holder.headers.pop('Cookie', None)
+
+    def update(self, cookies, save=True):
+        """登录成功后更新凭据，并同步到所有已注册的对象"""
+        with self.lock:
+            self.cookies = dict(cookies)
+            self.loaded = True
+            if save:
+                with open(self.path, 'w', encoding='utf-8') as f:
+                    json.dump(self.cookies, f, ensure_ascii=False, indent=2)
+        for holder in list(self.bound):
+            self.apply(holder)
+
+
+# 全局共享的凭据
+credentials = CredentialStore()
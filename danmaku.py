@@ -0,0 +1,470 @@
+import io
+import os
+import glob
+import json
+import math
+import zipfile
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from config import load_config
+from process import part_offsets
+from tracing import current_tracer
+
+# 弹幕按6分钟一段分段获取
+SEGMENT_SECONDS = 360
+# 解析弹幕时从网络流读取的缓冲大小，varint 逐字节读取时只访问这个缓冲
+READ_BUFFER_SIZE = 64 * 1024
+
+# DanmakuElem 的字段号
+DANMAKU_FIELDS = {
+    1: 'id', 2: 'progress', 3: 'mode', 4: 'fontsize', 5: 'color',
+    6: 'mid_hash', 7: 'content', 8: 'ctime', 9: 'weight', 11: 'pool',
+}
+STRING_FIELDS = {'mid_hash', 'content'}
+
+# 滚动弹幕的模式（6是逆向滚动，按普通滚动处理）；4为底部，5为顶部，其余为高级弹幕，不导出
+SCROLL_MODES = {1, 2, 3, 6}
+BOTTOM_MODE = 4
+TOP_MODE = 5
+
+
+def segment_count(duration):
+    return max(1, math.ceil(duration / SEGMENT_SECONDS))
+
+
+def decode_varint(data, pos):
+    """从 data[pos:] 解码一个varint，返回 (值, 新位置)"""
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def read_exact(read, size):
+    """从流中读满 size 字节"""
+    chunks = []
+    while size > 0:
+        chunk = read(size)
+        if not chunk:
+            raise EOFError("弹幕数据不完整")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def read_varint(read):
+    """从流中读取一个varint，流结束时返回None"""
+    result = 0
+    shift = 0
+    while True:
+        byte = read(1)
+        if not byte:
+            if shift:
+                raise EOFError("弹幕数据不完整")
+            return None
+        result |= (byte[0] & 0x7f) << shift
+        if not byte[0] & 0x80:
+            return result
+        shift += 7
+
+
+def skip_field(read, wire_type):
+    if wire_type == 0:
+        read_varint(read)
+    elif wire_type == 1:
+        read_exact(read, 8)
+    elif wire_type == 2:
+        read_exact(read, read_varint(read))
+    elif wire_type == 5:
+        read_exact(read, 4)
+    else:
+        raise ValueError(f"不支持的protobuf类型: {wire_type}")
+
+
+def parse_danmaku(data):
+    """解析一条 DanmakuElem"""
+    elem = {'progress': 0, 'mode': 1, 'fontsize': 25, 'color': 0xffffff,
+            'mid_hash': '', 'content': '', 'ctime': 0, 'pool': 0, 'id': 0}
+    pos = 0
+    while pos < len(data):
+        tag, pos = decode_varint(data, pos)
+        field, wire_type = tag >> 3, tag & 7
+        name = DANMAKU_FIELDS.get(field)
+        if wire_type == 0:
+            value, pos = decode_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = decode_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value, pos = None, pos + 8
+        elif wire_type == 5:
+            value, pos = None, pos + 4
+        else:
+            raise ValueError(f"不支持的protobuf类型: {wire_type}")
+        if name in STRING_FIELDS:
+            elem[name] = value.decode('utf-8', errors='replace')
+        elif name and isinstance(value, int):
+            elem[name] = value
+    return elem
+
+
+def iter_segment(read):
+    """从流中逐条解析一段弹幕（DmSegMobileReply），一次只在内存中保留一条"""
+    while True:
+        tag = read_varint(read)
+        if tag is None:
+            return
+        field, wire_type = tag >> 3, tag & 7
+        if field == 1 and wire_type == 2:
+            yield parse_danmaku(read_exact(read, read_varint(read)))
+        else:
+            skip_field(read, wire_type)
+
+
+def format_ass_time(seconds):
+    centiseconds = int(round(seconds * 100))
+    hours, centiseconds = divmod(centiseconds, 360000)
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    secs, centiseconds = divmod(centiseconds, 100)
+    return f"{hours}:{minutes:02d}:{secs:02d}.{centiseconds:02d}"
+
+
+def format_srt_time(seconds):
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    secs, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d},{milliseconds:03d}"
+
+
+class AssWriter:
+    """逐条写入ASS字幕格式的弹幕，不需要把全部弹幕读入内存
+
+    滚动弹幕按行分配轨道：新弹幕要等前一条完全进入屏幕，并且不会在左边追上前一条，
+    顶部和底部弹幕要等前一条消失。所有轨道都占满时丢弃该条弹幕。
+    """
+
+    def __init__(self, path, settings):
+        self.file = open(path, 'w', encoding='utf-8-sig')
+        self.width = settings['width']
+        self.height = settings['height']
+        self.font_size = settings['font_size']
+        self.scroll_duration = settings['scroll_duration']
+        self.fixed_duration = settings['fixed_duration']
+        self.line_height = int(self.font_size * 1.2)
+        lanes = max(1, int(self.height * settings['area'] / self.line_height))
+        # 滚动轨道记录 (前一条完全进入屏幕的时间, 前一条离开屏幕的时间)
+        self.scroll_lanes = [(0.0, 0.0)] * lanes
+        self.top_lanes = [0.0] * lanes
+        self.bottom_lanes = [0.0] * lanes
+        self.count = 0
+        self.dropped = 0
+
+        alpha = f"{int((1 - settings['opacity']) * 255):02X}"
+        self.file.write('\n'.join([
+            '[Script Info]',
+            'ScriptType: v4.00+',
+            f'PlayResX: {self.width}',
+            f'PlayResY: {self.height}',
+            '',
+            '[V4+ Styles]',
+            'Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, '
+            'Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, '
+            'Alignment, MarginL, MarginR, MarginV, Encoding',
+            f"Style: Danmaku,{settings['font']},{self.font_size},&H{alpha}FFFFFF,&H{alpha}FFFFFF,"
+            f"&H{alpha}000000,&H{alpha}000000,0,0,0,0,100,100,0,0,1,1,0,7,0,0,0,1",
+            '',
+            '[Events]',
+            'Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text',
+            ''
+        ]))
+
+    @staticmethod
+    def escape(text):
+        return text.replace('\\', '＼').replace('{', '｛').replace('}', '｝').replace('\n', '\\N')
+
+    def find_scroll_lane(self, start, speed):
+        for lane, (entered, left) in enumerate(self.scroll_lanes):
+            # 新弹幕头部到达左边时，前一条必须已经离开屏幕
+            if entered <= start and start + self.width / speed >= left:
+                return lane
+        return None
+
+    def find_fixed_lane(self, lanes, start):
+        for lane, free_time in enumerate(lanes):
+            if free_time <= start:
+                return lane
+        return None
+
+    def write(self, elem, offset=0):
+        """写入一条弹幕，offset 为所在分P在合并文件中的起始秒数"""
+        mode = elem['mode']
+        if mode not in SCROLL_MODES and mode not in (TOP_MODE, BOTTOM_MODE):
+            return
+        text = self.escape(elem['content'])
+        if not text:
+            return
+        start = elem['progress'] / 1000 + offset
+        size = int(self.font_size * elem['fontsize'] / 25)
+        # 按全角字符估算宽度
+        text_width = len(elem['content']) * size
+
+        if mode in SCROLL_MODES:
+            speed = (self.width + text_width) / self.scroll_duration
+            lane = self.find_scroll_lane(start, speed)
+            if lane is None:
+                self.dropped += 1
+                return
+            end = start + self.scroll_duration
+            self.scroll_lanes[lane] = (start + text_width / speed, end)
+            y = lane * self.line_height
+            position = f"\\move({self.width},{y},{-text_width},{y})"
+        else:
+            lanes = self.top_lanes if mode == TOP_MODE else self.bottom_lanes
+            lane = self.find_fixed_lane(lanes, start)
+            if lane is None:
+                self.dropped += 1
+                return
+            end = start + self.fixed_duration
+            lanes[lane] = end
+            y = lane * self.line_height if mode == TOP_MODE else self.height - (lane + 1) * self.line_height
+            position = f"\\an8\\pos({self.width // 2},{y})"
+
+        style = position
+        if size != self.font_size:
+            style += f"\\fs{size}"
+        color = elem['color'] & 0xffffff
+        if color != 0xffffff:
+            style += f"\\c&H{color & 0xff:02X}{(color >> 8) & 0xff:02X}{color >> 16:02X}&"
+        self.file.write(f"Dialogue: 2,{format_ass_time(start)},{format_ass_time(end)},Danmaku,,0,0,0,,"
+                        f"{{{style}}}{text}\n")
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+
+def zigzag(value):
+    """有符号数映射为无符号数，差分后的负数也只占很少字节"""
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def encode_varints(values, delta=False):
+    out = bytearray()
+    previous = 0
+    for value in values:
+        if delta:
+            value, previous = zigzag(value - previous), value
+        while value > 0x7f:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+
+def decode_varints(data, delta=False):
+    values = []
+    pos = 0
+    previous = 0
+    while pos < len(data):
+        value, pos = decode_varint(data, pos)
+        if delta:
+            value = previous = previous + unzigzag(value)
+        values.append(value)
+    return values
+
+
+class DanmakuArchive:
+    """紧凑的列式弹幕存档（zip）
+
+    每个分段写一组列：时间和发送时间按差分编码为varint，模式、字号、颜色等直接编码为varint，
+    用户哈希和内容为 \\0 分隔的UTF-8文本，每列单独压缩。同一列的数值相近，压缩后比JSON或XML小得多，
+    写入时一次只保留一个分段。
+    """
+
+    INT_COLUMNS = (('progress', True), ('ctime', True), ('id', True),
+                   ('mode', False), ('fontsize', False), ('color', False), ('pool', False))
+    TEXT_COLUMNS = ('mid_hash', 'content')
+
+    def __init__(self, path):
+        self.zip = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.segments = []
+
+    def write_segment(self, name, elems, offset=0, cid=None):
+        """写入一个分段，elems 需按 progress 排序"""
+        for column, delta in self.INT_COLUMNS:
+            values = [elem[column] for elem in elems]
+            if column == 'progress':
+                values = [value + int(offset * 1000) for value in values]
+            self.zip.writestr(f"{name}/{column}", encode_varints(values, delta))
+        for column in self.TEXT_COLUMNS:
+            self.zip.writestr(f"{name}/{column}", '\0'.join(elem[column].replace('\0', '') for elem in elems))
+        self.segments.append({'name': name, 'cid': cid, 'count': len(elems)})
+
+    def close(self):
+        meta = {
+            'version': 1,
+            'int_columns': [[column, delta] for column, delta in self.INT_COLUMNS],
+            'text_columns': list(self.TEXT_COLUMNS),
+            'segments': self.segments,
+        }
+        self.zip.writestr('meta.json', json.dumps(meta, ensure_ascii=False, indent=2))
+        self.zip.close()
+
+
+def read_archive(path):
+    """按分段读取存档中的弹幕，逐条产出"""
+    with zipfile.ZipFile(path) as archive:
+        meta = json.loads(archive.read('meta.json'))
+        for segment in meta['segments']:
+            name = segment['name']
+            columns = {}
+            for column, delta in meta['int_columns']:
+                columns[column] = decode_varints(archive.read(f"{name}/{column}"), delta)
+            for column in meta['text_columns']:
+                text = archive.read(f"{name}/{column}").decode('utf-8')
+                columns[column] = text.split('\0') if segment['count'] else []
+            for i in range(segment['count']):
+                yield {column: values[i] for column, values in columns.items()}
+
+
+class SrtWriter:
+    """写入SRT字幕"""
+
+    def __init__(self, path):
+        self.file = open(path, 'w', encoding='utf-8')
+        self.index = 0
+
+    def write(self, start, end, content, offset=0):
+        self.index += 1
+        self.file.write(f"{self.index}\n{format_srt_time(start + offset)} --> {format_srt_time(end + offset)}\n"
+                        f"{content}\n\n")
+
+    def close(self):
+        self.file.close()
+
+
+def export_paths(output_path):
+    """视频对应的弹幕和字幕文件"""
+    base, _ = os.path.splitext(output_path)
+    paths = [f"{base}.ass", f"{base}.danmaku.zip"] + sorted(glob.glob(glob.escape(base) + '.*.srt'))
+    return [path for path in paths if os.path.exists(path)]
+
+
+class DanmakuWorker(QThread):
+    """和视频流同时下载弹幕和CC字幕
+
+    sources 为 [(cid, 时长秒数, 在输出文件中的起始秒数)]，合并分P时多个分P写入同一组文件。
+    合并分P时 part_files 为各分P的视频文件，导出前按文件的实际时长重新计算起始秒数，和章节对齐。
+    弹幕和字幕是附带内容，导出失败只提示，不影响视频任务。
+    """
+
+    progress_updated = pyqtSignal(int, str)
+    status_updated = pyqtSignal(str)
+    stats_updated = pyqtSignal(str, int, int, float)
+    download_completed = pyqtSignal(bool, str)
+
+    def __init__(self, api, aid, sources, output_path, desc="弹幕", settings=None, part_files=None):
+        super().__init__()
+        self.api = api
+        self.aid = aid
+        self.sources = sources
+        self.part_files = part_files
+        self.base = os.path.splitext(output_path)[0]
+        self.desc = desc
+        self.settings = settings or load_config()['danmaku']
+        self.tracer = current_tracer()
+        self.is_running = True
+
+    def run(self):
+        with self.tracer.activate(), self.tracer.span(self.desc):
+            try:
+                if self.part_files:
+                    offsets = part_offsets([(path, source[1]) for path, source in zip(self.part_files, self.sources)])
+                    self.sources = [(cid, duration, offset) for (cid, duration, _), offset in zip(self.sources, offsets)]
+                count, dropped = self.export_danmaku()
+                self.status_updated.emit(f"弹幕导出完成: {count} 条" + (f"（{dropped} 条因重叠未写入ASS）" if dropped else ''))
+                if self.settings['subtitles']:
+                    languages = self.export_subtitles()
+                    if languages:
+                        self.status_updated.emit(f"字幕导出完成: {', '.join(languages)}")
+            except Exception as e:
+                self.status_updated.emit(f"弹幕导出失败: {str(e)}")
+        self.download_completed.emit(True, self.desc)
+
+    def export_danmaku(self):
+        """逐段下载并解析弹幕，每段写完后即释放，返回 (弹幕条数, ASS中丢弃的条数)"""
+        formats = self.settings['formats']
+        ass = AssWriter(f"{self.base}.ass", self.settings['ass']) if 'ass' in formats else None
+        archive = DanmakuArchive(f"{self.base}.danmaku.zip") if 'archive' in formats else None
+        total = 0
+        try:
+            for cid, duration, offset in self.sources:
+                for index in range(1, segment_count(duration) + 1):
+                    if not self.is_running:
+                        return total, ass.dropped if ass else 0
+                    with self.tracer.span('danmaku.segment', cid=cid, index=index) as span:
+                        response, error = self.api.get_danmaku_segment(self.aid, cid, index)
+                        if error:
+                            raise Exception(error)
+                        try:
+                            # 套一层缓冲，逐字节读取不再每次都经过 urllib3；
+                            # 关闭 auto_close，否则读到结尾后缓冲层再读会报错
+                            response.raw.decode_content = True
+                            response.raw.auto_close = False
+                            read = io.BufferedReader(response.raw, READ_BUFFER_SIZE).read
+                            elems = sorted(iter_segment(read), key=lambda elem: elem['progress'])
+                        finally:
+                            response.close()
+                        span['count'] = len(elems)
+                    if ass:
+                        for elem in elems:
+                            ass.write(elem, offset)
+                    if archive:
+                        archive.write_segment(f"{cid}_{index:04d}", elems, offset, cid)
+                    total += len(elems)
+        finally:
+            if ass:
+                ass.close()
+            if archive:
+                archive.close()
+        return total, ass.dropped if ass else 0
+
+    def export_subtitles(self):
+        """下载CC字幕并保存为SRT，每种语言一个文件，返回语言列表"""
+        writers = {}
+        try:
+            for cid, duration, offset in self.sources:
+                subtitles, error = self.api.get_subtitles(self.aid, cid)
+                if error:
+                    self.status_updated.emit(f"获取字幕失败: {error}")
+                    continue
+                for subtitle in subtitles:
+                    if not subtitle.get('subtitle_url'):
+                        continue
+                    body, error = self.api.get_subtitle_body(subtitle['subtitle_url'])
+                    if error:
+                        self.status_updated.emit(f"获取{subtitle['lan_doc']}字幕失败: {error}")
+                        continue
+                    language = subtitle['lan']
+                    if language not in writers:
+                        writers[language] = SrtWriter(f"{self.base}.{language}.srt")
+                    for item in body:
+                        writers[language].write(item['from'], item['to'], item['content'], offset)
+        finally:
+            for writer in writers.values():
+                writer.close()
+        return list(writers)
+
+    def stop(self):
+        self.is_running = False
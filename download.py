@@ -1,20 +1,67 @@
 import os
-import json
 import requests
 from PyQt5.QtCore import QThread, pyqtSignal
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from urllib.parse import parse_qs, urlparse
 import time
+from config import load_config
+from credentials import credentials
+from memory import get_buffer_pool
+from scheduler import get_scheduler
+from tracing import current_tracer
+from writer import BufferedFileWriter
+
+# 距离链接过期不足这么多秒时提前刷新地址
+URL_REFRESH_MARGIN = 120
+# 传输中断后从当前位置重新连接的最多次数
+MAX_RECONNECTS = 3
+
+
+def url_deadline(url):
+    """CDN签名地址中 deadline 参数给出的过期时间（Unix时间戳），没有时返回None"""
+    try:
+        return int(parse_qs(urlparse(url).query)['deadline'][0])
+    except (KeyError, IndexError, ValueError):
+        return None
+
+
+def content_range_total(response):
+    """206响应中 Content-Range 给出的文件总大小，没有时返回None"""
+    total = response.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+    return int(total) if total.isdigit() else None
+
+
+def stream_resolver(api, aid, cid, quality, kind, stream):
+    """返回重新获取下载地址的函数，kind 为 'video_stream' 或 'audio_stream'
+
+    返回的函数调用时重新请求 playurl，得到 (新地址, 错误信息)。
+    新的 playurl 中流的顺序可能变化，按原来流的 id（清晰度）和 codecid（编码）找回同一路，
+    否则续传时会把不同编码的数据拼到一起。
+    """
+    def resolve():
+        urls, error = api.get_download_urls(aid, cid, quality)
+        if error:
+            return None, error
+        for candidate in urls[f"{kind}s"]:
+            if candidate.get('id') == stream.get('id') and candidate.get('codecid') == stream.get('codecid'):
+                return candidate['baseUrl'], None
+        return None, "新的下载地址中没有原来的清晰度和编码"
+    return resolve
 
 
 class DownloadWorker(QThread):
     progress_updated = pyqtSignal(int, str)
     status_updated = pyqtSignal(str)
+    stats_updated = pyqtSignal(str, int, int, float)  # 流名称, 已下载字节, 总字节, 速度(B/s)
     download_completed = pyqtSignal(bool, str)
 
-    def __init__(self, url, save_path, desc):
+    def __init__(self, url, save_path, desc, url_resolver=None, tracer=None):
         super().__init__()
         self.url = url
+        self.deadline = url_deadline(url)
+        # 地址过期或返回403时用来重新获取地址，为None时不刷新
+        self.url_resolver = url_resolver
         self.save_path = save_path
         self.desc = desc
         self.headers = {
@@ -24,6 +71,11 @@ class DownloadWorker(QThread):
         self.session = self.create_session()
         self.load_cookies()
         self.is_running = True
+        # 文件总大小，第一次请求时确定，之后换地址续传时用来确认是同一个文件
+        self.file_size = None
+        # 任务时间线，未指定时使用创建线程中的当前任务
+        self.tracer = tracer or current_tracer()
+        self.stall_threshold = load_config()['tracing']['stall_threshold_ms'] / 1000
 
     def create_session(self):
         """创建带有重试机制的会话"""
@@ -39,18 +91,8 @@ class DownloadWorker(QThread):
         return session
 
     def load_cookies(self):
-        """加载保存的cookie"""
-        try:
-            if os.path.exists('bili_cookies.json'):
-                with open('bili_cookies.json', 'r', encoding='utf-8') as f:
-                    cookies = json.load(f)
-                    cookie_string = '; '.join([f'{k}={v}' for k, v in cookies.items()])
-                    self.headers['Cookie'] = cookie_string
-                return True
-            return False
-        except Exception as e:
-            self.status_updated.emit(f"加载cookie失败: {str(e)}")
-            return False
+        """使用共享的登录凭据，登录后会自动更新"""
+        return credentials.bind(self)
 
     def format_size(self, size_bytes):
         """格式化文件大小显示"""
@@ -61,63 +103,110 @@ class DownloadWorker(QThread):
         return f"{size_bytes:.2f}TB"
 
     def run(self):
+        # 内存预算用完时排队，等其他下载流结束后再开始
+        pool = get_buffer_pool()
+        with self.tracer.activate():
+            waited = self.tracer.now()
+            with pool.stream_slot(on_wait=lambda: self.status_updated.emit(f"{self.desc}等待内存配额...")):
+                self.tracer.complete(f"{self.desc}.wait_memory", waited)
+                with self.tracer.span(self.desc, save_path=self.save_path):
+                    self.download(pool)
+
+    def download(self, pool):
+        """下载文件，数据块使用缓冲区池中的复用缓冲区"""
         temp_path = f"{self.save_path}.tmp"
         first_byte = 0
 
         # 检查断点续传
         if os.path.exists(temp_path):
             first_byte = os.path.getsize(temp_path)
-            if first_byte > 0:
-                self.headers['Range'] = f'bytes={first_byte}-'
 
         try:
             # 创建保存目录
             os.makedirs(os.path.dirname(self.save_path), exist_ok=True)
 
-            # 获取响应
-            response = self.get_response(self.url)
-
-            # 检查响应状态
-            if response.status_code == 403:
-                self.status_updated.emit("下载失败：cookie已过期，请重新登录")
-                self.download_completed.emit(False, self.desc)
-                return
-            elif response.status_code not in [200, 206]:  # 206是断点续传的状态码
-                self.status_updated.emit(f"下载失败：HTTP {response.status_code}")
+            # 获取响应，地址过期时先刷新
+            response, error = self.open_stream(first_byte)
+            if error:
+                self.status_updated.emit(error)
                 self.download_completed.emit(False, self.desc)
                 return
 
-            # 获取文件大小
-            file_size = int(response.headers.get('content-length', 0))
-            if first_byte > 0:
-                file_size += first_byte
-            formatted_size = self.format_size(file_size)
+            file_size = self.file_size or 0
+            self.status_updated.emit(f"开始下载{self.desc}，大小: {self.format_size(file_size)}")
 
             mode = 'ab' if first_byte > 0 else 'wb'
             downloaded_size = first_byte
-            chunk_size = 1024 * 1024  # 1MB chunks
+            reconnects = 0
+            settings = load_config()['download']
+            # 所有下载共用的带宽限速，由调度器按时间段调整
+            limiter = get_scheduler().limiter
             start_time = time.time()
+            transfer_start = self.tracer.now()
 
             with open(temp_path, mode) as file:
-                for chunk in response.iter_content(chunk_size=chunk_size):
-                    if not self.is_running:
-                        break
+                # 网络读取和磁盘写入分在两个线程，磁盘慢时不会直接卡住socket
+                # 写完的数据块把所属缓冲区还给池子
+                writer = BufferedFileWriter(
+                    file, settings['write_queue_size'], settings['write_batch_size'],
+                    on_written=lambda chunk: pool.release(chunk.obj)
+                )
+                try:
+                    while self.is_running:
+                        # 限速下传输时间可能超过签名有效期，快过期时换新地址从当前位置继续
+                        if self.url_expiring():
+                            response.close()
+                            response, error = self.open_stream(downloaded_size)
+                            if error:
+                                raise Exception(error)
+
+                        buffer = pool.acquire()
+                        read_start = self.tracer.now()
+                        try:
+                            size = response.raw.readinto(buffer)
+                        except Exception as e:
+                            pool.release(buffer)
+                            if reconnects >= MAX_RECONNECTS:
+                                raise
+                            # 连接中断时从已下载的位置重新请求，保留已有进度
+                            reconnects += 1
+                            self.tracer.instant('reconnect', offset=downloaded_size, error=str(e))
+                            self.status_updated.emit(f"{self.desc}连接中断({str(e)})，从 {self.format_size(downloaded_size)} 处继续")
+                            response.close()
+                            response, error = self.open_stream(downloaded_size)
+                            if error:
+                                raise Exception(error)
+                            continue
+                        if not size:
+                            pool.release(buffer)
+                            break
 
-                    if chunk:
-                        size = file.write(chunk)
+                        # 读取、写盘排队、限速等待超过阈值时记为卡顿
+                        self.mark_stall('stall', read_start, bytes=size)
+                        put_start = self.tracer.now()
+                        writer.put(memoryview(buffer)[:size])
+                        self.mark_stall('disk_backpressure', put_start)
                         downloaded_size += size
+                        throttle_start = self.tracer.now()
+                        limiter.acquire(size)
+                        self.mark_stall('throttle', throttle_start)
                         progress = int((downloaded_size / file_size) * 100) if file_size > 0 else 0
 
-                        # 计算下载速度
+                        # 计算下载速度，进度和速度通过结构化信号交给任务列表显示
                         elapsed_time = time.time() - start_time
                         if elapsed_time > 0:
-                            speed = downloaded_size / (1024 * 1024 * elapsed_time)  # MB/s
-                            downloaded_formatted = self.format_size(downloaded_size)
-                            self.status_updated.emit(
-                                f"正在下载{self.desc}: {downloaded_formatted}/{formatted_size} ({progress}%) - {speed:.2f}MB/s"
-                            )
+                            speed = (downloaded_size - first_byte) / elapsed_time  # B/s
+                            self.stats_updated.emit(self.desc, downloaded_size, file_size, speed)
 
                         self.progress_updated.emit(progress, self.desc)
+                finally:
+                    # 异常时也要结束写入线程，保证已读到的数据落盘
+                    writer.close()
+                    self.tracer.complete('transfer', transfer_start, bytes=downloaded_size - first_byte,
+                                         reconnects=reconnects, writer=writer.summary())
+                    if response is not None:
+                        response.close()
+                self.status_updated.emit(f"{self.desc}{writer.summary()}")
 
             if self.is_running:
                 # 下载完成，将临时文件重命名为最终文件
@@ -138,6 +227,77 @@ class DownloadWorker(QThread):
             self.status_updated.emit(f"下载{self.desc}出错: {str(e)}")
             self.download_completed.emit(False, self.desc)
 
+    def mark_stall(self, name, start, **args):
+        """等待超过阈值时在时间线上记录一段卡顿"""
+        if self.tracer.enabled and self.tracer.now() - start >= self.stall_threshold:
+            self.tracer.complete(name, start, **args)
+
+    def url_expiring(self):
+        """地址是否即将过期（只有能刷新时才判断）"""
+        return (self.url_resolver is not None and self.deadline is not None
+                and time.time() > self.deadline - URL_REFRESH_MARGIN)
+
+    def refresh_url(self):
+        """重新获取下载地址，返回错误信息"""
+        with self.tracer.span('refresh_url'):
+            url, error = self.url_resolver()
+        if error:
+            return f"刷新{self.desc}下载地址失败：{error}"
+        self.url = url
+        self.deadline = url_deadline(url)
+        self.status_updated.emit(f"{self.desc}下载地址已刷新")
+        return None
+
+    def open_stream(self, offset):
+        """从 offset 处请求数据，返回 (响应, 错误信息)
+
+        地址快过期时先刷新；返回403一般是签名地址过期，刷新地址后再试一次。
+        """
+        if self.url_expiring():
+            error = self.refresh_url()
+            if error:
+                return None, error
+
+        for attempt in range(2):
+            if offset > 0:
+                self.headers['Range'] = f'bytes={offset}-'
+            else:
+                self.headers.pop('Range', None)
+            # 从发出请求到收到响应头：包括DNS、建立连接、TLS握手和首字节等待
+            with self.tracer.span('connect+ttfb', offset=offset) as span:
+                response = self.get_response(self.url)
+                span['status'] = response.status_code
+                span['elapsed_ms'] = response.elapsed.total_seconds() * 1000
+            if response.status_code == 403 and attempt == 0 and self.url_resolver:
+                response.close()
+                error = self.refresh_url()
+                if error:
+                    return None, error
+                continue
+            break
+
+        # 检查响应状态
+        if response.status_code == 403:
+            response.close()
+            return None, f"下载{self.desc}失败：下载地址已失效或无访问权限(HTTP 403)"
+        elif response.status_code not in [200, 206]:  # 206是断点续传的状态码
+            response.close()
+            return None, f"下载失败：HTTP {response.status_code}"
+        elif offset > 0 and response.status_code != 206:
+            response.close()
+            return None, f"下载{self.desc}失败：服务器不支持断点续传"
+
+        # 只有总大小一致才接着写，避免把不同的文件拼在一起
+        if response.status_code == 206:
+            total = content_range_total(response)
+        else:
+            total = int(response.headers.get('content-length', 0)) or None
+        if self.file_size and total and total != self.file_size:
+            response.close()
+            return None, f"下载{self.desc}失败：新地址的文件大小与原文件不一致，无法续传"
+        self.file_size = self.file_size or total
+        return response, None
+
     def get_response(self, url):
         """获取响应"""
         try:
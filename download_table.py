@@ -0,0 +1,197 @@
+from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QLineEdit, QComboBox,
+                             QTableView, QHeaderView, QAbstractItemView, QStyledItemDelegate,
+                             QStyleOptionProgressBar, QApplication, QStyle)
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QSortFilterProxyModel, QTimer
+
+
+def format_size(size_bytes):
+    """格式化文件大小显示"""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size_bytes < 1024:
+            return f"{size_bytes:.2f}{unit}"
+        size_bytes /= 1024
+    return f"{size_bytes:.2f}TB"
+
+
+def format_eta(seconds):
+    """格式化剩余时间显示"""
+    if seconds is None:
+        return '--'
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60:02d}:{seconds % 60:02d}"
+
+
+class DownloadTableModel(QAbstractTableModel):
+    """下载任务表格模型，每个任务一行
+
+    工作线程的更新先存到 pending 中，由定时器按固定频率批量刷新到视图，
+    大量任务同时更新时界面刷新次数不会随信号数量增长。
+    """
+
+    COLUMNS = ['任务', '阶段', '进度', '速度', '剩余时间', '大小']
+    TITLE, STAGE, PROGRESS, SPEED, ETA, SIZE = range(6)
+
+    def __init__(self, refresh_interval=200, parent=None):
+        super().__init__(parent)
+        self.jobs = []
+        self.rows = {}  # job_id -> 行号
+        self.pending_updates = {}
+        self.pending_jobs = []
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.flush)
+        self.timer.start(refresh_interval)
+
+    def add_job(self, job_id, title, stage='排队中'):
+        """添加任务，下次刷新时显示"""
+        self.pending_jobs.append({
+            'id': job_id, 'title': title, 'stage': stage,
+            'progress': 0, 'speed': 0.0, 'eta': None, 'size': 0
+        })
+
+    def update_job(self, job_id, **fields):
+        """更新任务字段，同一任务在一个刷新周期内的多次更新会合并"""
+        self.pending_updates.setdefault(job_id, {}).update(fields)
+
+    def flush(self):
+        """把积累的新增和更新一次性应用到模型"""
+        if self.pending_jobs:
+            first = len(self.jobs)
+            self.beginInsertRows(QModelIndex(), first, first + len(self.pending_jobs) - 1)
+            for job in self.pending_jobs:
+                self.rows[job['id']] = len(self.jobs)
+                self.jobs.append(job)
+            self.endInsertRows()
+            self.pending_jobs = []
+
+        if self.pending_updates:
+            changed_rows = []
+            for job_id, fields in self.pending_updates.items():
+                row = self.rows.get(job_id)
+                if row is not None:
+                    self.jobs[row].update(fields)
+                    changed_rows.append(row)
+            self.pending_updates = {}
+            if changed_rows:
+                # 一次通知覆盖所有变化的行
+                self.dataChanged.emit(
+                    self.index(min(changed_rows), 0),
+                    self.index(max(changed_rows), len(self.COLUMNS) - 1)
+                )
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.jobs)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.COLUMNS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        job = self.jobs[index.row()]
+        column = index.column()
+
+        if role == Qt.DisplayRole:
+            if column == self.TITLE:
+                return job['title']
+            elif column == self.STAGE:
+                return job['stage']
+            elif column == self.PROGRESS:
+                return f"{job['progress']}%"
+            elif column == self.SPEED:
+                return f"{format_size(job['speed'])}/s" if job['speed'] else '--'
+            elif column == self.ETA:
+                return format_eta(job['eta'])
+            elif column == self.SIZE:
+                return format_size(job['size']) if job['size'] else '--'
+        elif role == Qt.UserRole:
+            # 排序使用原始数值
+            key = ['title', 'stage', 'progress', 'speed', 'eta', 'size'][column]
+            value = job[key]
+            return -1 if value is None else value
+        elif role == Qt.TextAlignmentRole and column != self.TITLE:
+            return Qt.AlignCenter
+        return None
+
+
+class ProgressDelegate(QStyledItemDelegate):
+    """在进度列中绘制进度条"""
+
+    def paint(self, painter, option, index):
+        progress = index.data(Qt.UserRole)
+        bar = QStyleOptionProgressBar()
+        bar.rect = option.rect.adjusted(2, 2, -2, -2)
+        bar.minimum = 0
+        bar.maximum = 100
+        bar.progress = progress
+        bar.text = f"{progress}%"
+        bar.textVisible = True
+        QApplication.style().drawControl(QStyle.CE_ProgressBar, bar, painter)
+
+
+class DownloadFilterProxy(QSortFilterProxyModel):
+    """同时按任务名关键字和阶段过滤"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.keyword = ''
+        self.stage = None
+
+    def set_keyword(self, keyword):
+        self.keyword = keyword.lower()
+        self.invalidateFilter()
+
+    def set_stage(self, stage):
+        self.stage = None if stage == '全部' else stage
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        job = self.sourceModel().jobs[source_row]
+        if self.stage and job['stage'] != self.stage:
+            return False
+        return not self.keyword or self.keyword in job['title'].lower()
+
+
+class DownloadManagerView(QWidget):
+    """下载任务列表：按阶段和关键字过滤，点击表头排序"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.model = DownloadTableModel(parent=self)
+        self.proxy = DownloadFilterProxy(self)
+        self.proxy.setSourceModel(self.model)
+        self.proxy.setSortRole(Qt.UserRole)
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+
+        filter_layout = QHBoxLayout()
+        self.filter_input = QLineEdit()
+        self.filter_input.setPlaceholderText("按任务名过滤")
+        self.filter_input.textChanged.connect(self.proxy.set_keyword)
+        self.stage_combo = QComboBox()
+        self.stage_combo.addItems(['全部', '排队中', '等待时段', '等待磁盘空间', '下载中', '合并中', '后处理中', '上传中', '完成', '失败'])
+        self.stage_combo.currentTextChanged.connect(self.proxy.set_stage)
+        filter_layout.addWidget(self.filter_input)
+        filter_layout.addWidget(self.stage_combo)
+        layout.addLayout(filter_layout)
+
+        self.table = QTableView()
+        self.table.setModel(self.proxy)
+        self.table.setSortingEnabled(True)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.verticalHeader().setVisible(False)
+        # 固定行高，避免按内容计算每一行的高度
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.table.verticalHeader().setDefaultSectionSize(24)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Interactive)
+        self.table.horizontalHeader().setSectionResizeMode(DownloadTableModel.TITLE, QHeaderView.Stretch)
+        self.table.setItemDelegateForColumn(DownloadTableModel.PROGRESS, ProgressDelegate(self.table))
+        layout.addWidget(self.table)
@@ -0,0 +1,144 @@
+import sys
+import time
+import qrcode
+import requests
+from io import BytesIO
+from urllib.parse import parse_qs, urlparse
+
+from config import load_config
+from credentials import credentials
+
+# 扫码状态
+QR_SUCCESS = 0
+QR_EXPIRED = 86038
+QR_WAITING = 86090
+QR_SCANNED = 86101
+
+
+class LoginSession:
+    """扫码登录会话，复用同一个连接完成获取二维码和轮询"""
+
+    def __init__(self):
+        self.session = requests.Session()
+        self.session.headers.update({
+            'referer': 'https://www.bilibili.com/',
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+        })
+        settings = load_config()['api']
+        self.timeout = (settings['connect_timeout'], settings['read_timeout'])
+        self.qr_key = None
+        self.waiting_polls = 0
+
+    def generate(self):
+        """获取二维码，返回 (二维码内容, 错误信息)"""
+        response = self.session.get(
+            'https://passport.bilibili.com/x/passport-login/web/qrcode/generate',
+            timeout=self.timeout
+        )
+        data = response.json()
+        if data['code'] != 0:
+            return None, f'获取二维码失败：{data.get("message", "未知错误")}'
+        self.qr_key = data['data']['qrcode_key']
+        self.waiting_polls = 0
+        return data['data']['url'], None
+
+    def poll(self):
+        """查询扫码状态，返回 (状态码, cookies, 提示信息)"""
+        response = self.session.get(
+            'https://passport.bilibili.com/x/passport-login/web/qrcode/poll',
+            params={'qrcode_key': self.qr_key},
+            timeout=self.timeout
+        )
+        data = response.json()
+        if data['code'] != 0:
+            return None, None, f'检查状态失败：{data.get("message", "未知错误")}'
+
+        status = data['data'].get('code')
+        if status == QR_SUCCESS:
+            cookies = self.parse_cookies(data['data'].get('url', ''))
+            if not cookies:
+                return status, None, '获取Cookie失败，缺少必要信息'
+            return status, cookies, '登录成功！'
+        elif status == QR_EXPIRED:
+            return status, None, '二维码已过期，请点击刷新重试'
+        elif status == QR_WAITING:
+            self.waiting_polls += 1
+            return status, None, '请使用哔哩哔哩App扫描二维码登录'
+        elif status == QR_SCANNED:
+            return status, None, '已扫描，请在手机上确认登录'
+        return status, None, f'未知状态({status})，请刷新重试'
+
+    @staticmethod
+    def parse_cookies(url):
+        """从登录成功返回的url参数中解析cookie"""
+        params = parse_qs(urlparse(url).query)
+        cookies = {}
+        for key in ['SESSDATA', 'bili_jct', 'DedeUserID', 'DedeUserID__ckMd5']:
+            if key in params:
+                cookies[key] = params[key][0]
+        # 检查必要的cookie是否都存在
+        if not all(key in cookies for key in ['SESSDATA', 'bili_jct', 'DedeUserID']):
+            return None
+        return cookies
+
+    def next_interval(self, status):
+        """根据扫码状态决定下次轮询的间隔（毫秒）
+
+        已扫码时用户很快会确认，轮询加快；长时间未扫码则逐渐放慢，最长5秒。
+        """
+        if status == QR_SCANNED:
+            return 1000
+        return min(2000 + self.waiting_polls * 250, 5000)
+
+    @staticmethod
+    def make_qr(url):
+        qr = qrcode.QRCode(
+            version=1,
+            error_correction=qrcode.constants.ERROR_CORRECT_L,
+            box_size=10,
+            border=2,
+        )
+        qr.add_data(url)
+        qr.make(fit=True)
+        return qr
+
+    @classmethod
+    def render_png(cls, url):
+        """生成二维码PNG数据"""
+        img = cls.make_qr(url).make_image(fill_color="black", back_color="white")
+        buffer = BytesIO()
+        img.save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    @classmethod
+    def print_terminal(cls, url):
+        """在终端中打印二维码"""
+        cls.make_qr(url).print_ascii(invert=True)
+
+
+def terminal_login():
+    """无界面扫码登录：在终端打印二维码并等待扫码"""
+    login = LoginSession()
+    url, error = login.generate()
+    if error:
+        print(error)
+        return False
+    LoginSession.print_terminal(url)
+
+    last_message = None
+    while True:
+        status, cookies, message = login.poll()
+        if message != last_message:
+            print(message)
+            last_message = message
+        if status == QR_SUCCESS and cookies:
+            credentials.update(cookies)
+            print('登录信息已保存')
+            return True
+        if status not in (QR_WAITING, QR_SCANNED):
+            return False
+        time.sleep(login.next_interval(status) / 1000)
+
+
+if __name__ == '__main__':
+    sys.exit(0 if terminal_login() else 1)
@@ -1,13 +1,32 @@
 import sys
 import os
+import re
+import time
+import itertools
+import multiprocessing
+from collections import deque
 from PyQt5.QtWidgets import QApplication, QMessageBox, QFileDialog
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
 from PyQt5.QtGui import QIcon
 #从其他代码中引入
 from ui import BilibiliDownloaderUI
-from download import DownloadWorker
-from process import merge_video_audio, get_video_quality
+from download_table import format_size
+from download import DownloadWorker, stream_resolver
+from clip import ClipWorker, parse_time
+from danmaku import DanmakuWorker
+from process import merge_video_audio, concat_parts, get_video_quality
 from bilibili_api import BilibiliAPI
-from bili_login import BiliLogin, format_cookie_string
+from config import load_config
+from tasks import TaskRunner
+from postprocess import PostProcessor
+from sinks import create_sink, deliver_outputs, is_passthrough
+from scheduler import get_scheduler
+from tracing import NULL_TRACER, create_tracer
+from planner import estimate_sizes, peak_disk_usage, get_disk_budget
+from bili_login import BiliLogin
+from credentials import credentials
+
+BV_PATTERN = re.compile(r'BV[0-9A-Za-z]{10}')
 
 def resource_path(relative_path):
     """ 获取资源的绝对路径 """
@@ -17,21 +36,59 @@ def resource_path(relative_path):
         base_path = os.path.abspath(".")
     return os.path.join(base_path, relative_path)
 
+class PostProcessSignals(QObject):
+    """把后处理线程中的回调转到界面线程"""
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal(int, bool, str)
+
 class BilibiliDownloader(BilibiliDownloaderUI):
     def __init__(self):
         super(BilibiliDownloader, self).__init__()
         self.video_meta = None
-        self.video_downloaded = False
-        self.audio_downloaded = False
         self.api = BilibiliAPI()
+        # 下载任务：job_id -> 任务信息
+        self.jobs = {}
+        self.job_counter = itertools.count(1)
+        self.pending_jobs = deque()
+        self.active_jobs = set()
+        self.max_active_jobs = load_config()['download']['max_active_jobs']
+        self.max_disk_wait = load_config()['download']['max_disk_wait_minutes'] * 60
+        # 接口请求在后台线程执行，界面线程不会被阻塞
+        self.task_runner = TaskRunner(parent=self)
+        self.query_timer = QTimer(self)
+        self.query_timer.setSingleShot(True)
+        self.query_timer.setInterval(400)
+        # 配置了后处理阶段时才创建进程池
+        self.post_processor = PostProcessor() if load_config()['postprocess']['stages'] else None
+        # 按时间段放行任务、调整带宽
+        self.scheduler = get_scheduler()
+        self.schedule_message = None
+        self.schedule_timer = QTimer(self)
+        self.schedule_timer.timeout.connect(self.refresh_schedule)
+        self.schedule_timer.start(30 * 1000)
+        self.scheduler.update(0)
+        self.danmaku_enabled = load_config()['danmaku']['enabled']
+        # 按剩余磁盘空间放行任务
+        self.disk_budget = get_disk_budget()
+        # 完成的文件交付到配置的输出位置，上传使用单独的线程池，不占用接口请求的线程
+        self.sink = create_sink()
+        self.output_runner = TaskRunner(max_threads=2, parent=self)
+        self.post_signals = PostProcessSignals()
+        self.post_signals.progress.connect(
+            lambda job_id, percent: self.download_table.model.update_job(job_id, progress=percent)
+        )
+        self.post_signals.finished.connect(self.handle_post_process_finished)
         self.setWindowIcon(QIcon(resource_path('app.ico')))
         self.setup_connections()
         self.load_cookies()
 
     def setup_connections(self):
         """设置信号连接"""
-        self.query_btn.clicked.connect(self.query_video)
+        self.query_btn.clicked.connect(lambda: self.query_video())
+        self.bv_input.textChanged.connect(self.on_bv_text_changed)
+        self.query_timer.timeout.connect(lambda: self.query_video(interactive=False))
         self.download_btn.clicked.connect(self.start_download)
+        self.estimate_btn.clicked.connect(self.show_schedule_estimate)
         self.select_path_btn.clicked.connect(self.select_download_path)
         self.login_btn.clicked.connect(self.show_login_dialog)
 
@@ -43,15 +100,12 @@ class BilibiliDownloader(BilibiliDownloaderUI):
 
     def handle_login_success(self, cookie_dict):
         """处理登录成功"""
-        # 更新API中的cookie
-        self.api.headers['Cookie'] = format_cookie_string(cookie_dict)
+        # 共享凭据已在登录对话框中更新，API和下载线程会直接使用新的cookie
         self.status_text.append("登录成功！Cookie已更新")
 
     def load_cookies(self):
         """加载保存的cookie"""
-        cookies = BiliLogin.load_cookies()
-        if cookies:
-            self.api.headers['Cookie'] = format_cookie_string(cookies)
+        if credentials.bind(self.api):
             self.status_text.append("已加载保存的登录信息")
 
     def select_download_path(self):
@@ -65,16 +119,35 @@ class BilibiliDownloader(BilibiliDownloaderUI):
         if path:
             self.path_input.setText(path)
 
-    def query_video(self):
-        """查询视频信息"""
+    def on_bv_text_changed(self, text):
+        """输入完整BV号后稍等片刻自动查询"""
+        if BV_PATTERN.fullmatch(text.strip()):
+            self.query_timer.start()
+        else:
+            self.query_timer.stop()
+
+    def query_video(self, interactive=True):
+        """查询视频信息（在后台线程中请求，重新查询时丢弃旧结果）"""
         bv_number = self.bv_input.text().strip()
         if not bv_number:
-            QMessageBox.warning(self, '警告', '请输入BV号')
+            if interactive:
+                QMessageBox.warning(self, '警告', '请输入BV号')
             return
 
-        video_info, error = self.api.get_video_info(bv_number)
+        self.video_info.setText(f"正在查询 {bv_number} ...")
+        self.task_runner.submit(
+            'query', self.api.get_video_info, bv_number,
+            on_done=lambda result: self.handle_query_result(bv_number, result, interactive),
+            on_error=lambda message: self.video_info.setText(f"查询失败: {message}")
+        )
+
+    def handle_query_result(self, bv_number, result, interactive):
+        """处理查询结果"""
+        video_info, error = result
         if error:
-            QMessageBox.warning(self, '错误', error)
+            self.video_info.setText(f"{bv_number}: {error}")
+            if interactive:
+                QMessageBox.warning(self, '错误', error)
             return
 
         self.video_meta = video_info
@@ -116,94 +189,483 @@ class BilibiliDownloader(BilibiliDownloaderUI):
             QMessageBox.warning(self, '警告', '请选择下载路径')
             return
 
-        try:
-            # 获取下载参数
-            aid = self.video_meta['aid']
-            cid = self.part_combo.currentData()
-            quality = self.quality_combo.currentData()
-            title = self.video_meta['title'].replace(" ", "_")
+        # 在提交后台任务前记下当前选择，避免请求期间界面被修改
+        video_meta = self.video_meta
+        cid = self.part_combo.currentData()
+        part = self.part_combo.currentText()
+        quality = self.quality_combo.currentData()
+        clip_text = (self.clip_start_input.text().strip(), self.clip_end_input.text().strip())
+
+        # 每个任务一条时间线，从解析下载链接开始记录
+        tracer = create_tracer(f"{video_meta['bvid']}_{'all' if self.concat_checkbox.isChecked() else cid}")
+
+        # 合并全部分P：所有分P作为一个任务，下载完后拼接成一个带章节的文件
+        if self.concat_checkbox.isChecked() and len(video_meta['pages']) > 1:
+            if any(clip_text):
+                QMessageBox.warning(self, '警告', '合并全部分P时不支持截取片段')
+                return
+            self.status_text.append("正在获取所有分P的下载链接...")
+            self.task_runner.submit(
+                None, self.resolve_series, video_meta['aid'], video_meta['pages'], quality, tracer,
+                on_done=lambda result: self.enqueue_series_job(result, video_meta, quality, download_path, tracer),
+                on_error=lambda message: QMessageBox.warning(self, '错误', f"获取下载链接出错: {message}")
+            )
+            return
 
-            # 获取下载链接
+        # 获取下载链接
+        self.status_text.append("正在获取下载链接...")
+        self.task_runner.submit(
+            None, self.resolve_download, video_meta['aid'], cid, quality, tracer,
+            on_done=lambda result: self.enqueue_job(result, video_meta, cid, part, quality, download_path, clip_text,
+                                                    tracer),
+            on_error=lambda message: QMessageBox.warning(self, '错误', f"获取下载链接出错: {message}")
+        )
+
+    def resolve_download(self, aid, cid, quality, tracer=NULL_TRACER):
+        """（后台线程）获取下载链接并估算大小"""
+        with tracer.activate():
             urls, error = self.api.get_download_urls(aid, cid, quality)
+            if error:
+                return None, error
+            with tracer.span('estimate_size', 'plan'):
+                urls['sizes'] = estimate_sizes(self.api, urls)
+        return urls, None
+
+    def resolve_series(self, aid, pages, quality, tracer=NULL_TRACER):
+        """（后台线程）获取所有分P的下载链接并估算大小"""
+        results = []
+        for page in pages:
+            urls, error = self.resolve_download(aid, page['cid'], quality, tracer)
+            if error:
+                return None, f"P{page['page']}: {error}"
+            results.append(urls)
+        return results, None
+
+    def enqueue_job(self, result, video_meta, cid, part, quality, download_path, clip_text, tracer=NULL_TRACER):
+        """拿到下载链接后创建任务"""
+        try:
+            urls, error = result
             if error:
                 QMessageBox.warning(self, '错误', error)
                 return
 
             # 准备下载路径
+            title = video_meta['title'].replace(" ", "_")
             paths, error = self.api.prepare_download_paths(download_path, title)
             if error:
                 QMessageBox.warning(self, '错误', error)
                 return
 
-            # 创建下载工作线程
-            self.video_worker = DownloadWorker(urls['video_url'], paths['video_path'], "视频流")
-            self.audio_worker = DownloadWorker(urls['audio_url'], paths['audio_path'], "音频流")
-
-            # 连接信号
-            self.video_worker.progress_updated.connect(self.update_progress)
-            self.audio_worker.progress_updated.connect(self.update_progress)
-            self.video_worker.status_updated.connect(self.update_status)
-            self.audio_worker.status_updated.connect(self.update_status)
-            self.video_worker.download_completed.connect(
-                lambda success, desc: self.handle_download_completed(
-                    success, desc, paths['video_path'], paths['audio_path'], paths['output_path']
-                )
-            )
-            self.audio_worker.download_completed.connect(
-                lambda success, desc: self.handle_download_completed(
-                    success, desc, paths['video_path'], paths['audio_path'], paths['output_path']
-                )
+            # 填写了时间段则只下载片段
+            clip_start, clip_end = clip_text
+            clip = None
+            if clip_start or clip_end:
+                clip = self.parse_clip_range(urls, clip_start, clip_end)
+                if not clip:
+                    return
+
+            # 估算大小，用于排期、限速和磁盘空间检查；片段按时长比例估算
+            estimated_size = sum(urls['sizes'].values())
+            if clip and urls['duration']:
+                estimated_size = int(estimated_size * min((clip[1] - clip[0]) / urls['duration'], 1))
+
+            job_title = f"{video_meta['title']} - {part}" if len(video_meta['pages']) > 1 else video_meta['title']
+            self.add_job(
+                job_title, estimated_size,
+                urls=urls,
+                # 签名地址过期时重新获取
+                resolvers=[stream_resolver(self.api, video_meta['aid'], cid, quality, kind, urls[kind])
+                           for kind in ('video_stream', 'audio_stream')],
+                paths=paths,
+                clip=clip,
+                aid=video_meta['aid'],
+                cid=cid,
+                tracer=tracer
             )
 
-            # 启动下载
-            self.video_worker.start()
-            self.audio_worker.start()
+        except Exception as e:
+            QMessageBox.warning(self, '错误', f"下载过程出错: {str(e)}")
+            self.status_text.append(f"错误详情: {str(e)}")
+
+    def enqueue_series_job(self, result, video_meta, quality, download_path, tracer=NULL_TRACER):
+        """拿到所有分P的下载链接后创建合并任务"""
+        try:
+            all_urls, error = result
+            if error:
+                QMessageBox.warning(self, '错误', error)
+                return
+
+            title = video_meta['title'].replace(" ", "_")
+            paths, error = self.api.prepare_download_paths(download_path, title)
+            if error:
+                QMessageBox.warning(self, '错误', error)
+                return
 
-            self.download_btn.setEnabled(False)
-            self.status_text.append(f"开始下载到: {download_path}")
+            parts = []
+            for page, urls in zip(video_meta['pages'], all_urls):
+                part_paths, error = self.api.prepare_download_paths(download_path, f"{title}_P{page['page']}")
+                if error:
+                    QMessageBox.warning(self, '错误', error)
+                    return
+                parts.append({
+                    'cid': page['cid'],
+                    'label': f"P{page['page']}",
+                    'title': page['part'],
+                    'duration': page['duration'],
+                    'urls': urls,
+                    'paths': part_paths,
+                    'size': sum(urls['sizes'].values()),
+                    'resolvers': [stream_resolver(self.api, video_meta['aid'], page['cid'], quality, kind, urls[kind])
+                                  for kind in ('video_stream', 'audio_stream')],
+                })
+
+            estimated_size = sum(part['size'] for part in parts)
+            self.add_job(f"{video_meta['title']}（{len(parts)}P合并）", estimated_size,
+                         paths=paths, parts=parts, aid=video_meta['aid'], tracer=tracer)
 
         except Exception as e:
             QMessageBox.warning(self, '错误', f"下载过程出错: {str(e)}")
             self.status_text.append(f"错误详情: {str(e)}")
 
-    def update_progress(self, progress, desc):
-        """更新进度条"""
-        if desc == "视频流":
-            self.video_progress.setValue(progress)
+    def add_job(self, title, estimated_size, **fields):
+        """加入任务队列，由 try_start_jobs 按并发上限启动"""
+        job_id = next(self.job_counter)
+        self.jobs[job_id] = {
+            'title': title,
+            'urls': None,
+            'resolvers': None,
+            'paths': None,
+            'clip': None,
+            'aid': None,
+            'cid': None,
+            # 合并分P任务的各个分P，按顺序逐个下载
+            'parts': None,
+            'part_index': 0,
+            'pending_size': 0,
+            'estimated_size': estimated_size,
+            'peak_size': peak_disk_usage(estimated_size),
+            'tracer': NULL_TRACER,
+            'workers': [],
+            'stats': {},
+            'finished': {},
+            # 第一次因磁盘空间不够而等待的时间
+            'disk_wait_since': None
+        }
+        self.jobs[job_id].update(fields)
+        self.download_table.model.add_job(job_id, title)
+        self.download_table.model.update_job(job_id, size=estimated_size)
+        self.pending_jobs.append(job_id)
+        self.status_text.append(f"已加入下载队列: {title}")
+        self.refresh_schedule()
+
+    def parse_clip_range(self, urls, clip_start, clip_end):
+        """解析片段起止时间，格式错误时返回None"""
+        try:
+            start = parse_time(clip_start) if clip_start else 0.0
+            end = parse_time(clip_end) if clip_end else float(urls['duration'])
+        except ValueError:
+            QMessageBox.warning(self, '警告', '时间格式不正确，请输入如 90、1:30 或 0:01:30')
+            return None
+        if end <= start:
+            QMessageBox.warning(self, '警告', '结束时间必须大于开始时间')
+            return None
+        return start, end
+
+    def try_start_jobs(self):
+        """在并发上限内启动排队中的任务，不在下载时段内时继续等待"""
+        if not self.scheduler.is_open():
+            for job_id in self.pending_jobs:
+                self.download_table.model.update_job(job_id, stage='等待时段')
+            return
+        for job_id in self.admission_order():
+            if len(self.active_jobs) >= self.max_active_jobs:
+                break
+            job = self.jobs[job_id]
+            directory = os.path.dirname(job['paths']['output_path'])
+            if self.disk_budget.try_reserve(job_id, directory, job['peak_size']):
+                self.pending_jobs.remove(job_id)
+                self.start_job(job_id)
+            elif self.disk_budget.is_idle(directory):
+                # 没有其他任务占用空间时仍然放不下，继续等待也没有意义
+                self.pending_jobs.remove(job_id)
+                self.download_table.model.update_job(job_id, stage='失败')
+                self.update_status(f"磁盘空间不足，需要约 {format_size(job['peak_size'])}: {job['title']}")
+            else:
+                self.download_table.model.update_job(job_id, stage='等待磁盘空间')
+                if job['disk_wait_since'] is None:
+                    job['disk_wait_since'] = time.monotonic()
+                if self.is_starving(job_id):
+                    # 等待太久的任务放行前不再放行其他任务，释放出的空间留给它
+                    break
+
+    def is_starving(self, job_id):
+        """任务等待磁盘空间是否已超过 max_disk_wait_minutes"""
+        since = self.jobs[job_id]['disk_wait_since']
+        return since is not None and time.monotonic() - since >= self.max_disk_wait
+
+    def admission_order(self):
+        """排队任务的放行顺序
+
+        小任务优先，在磁盘空间内尽量多放行任务；等待太久的大任务按排队先后排到最前，
+        避免小任务不断插队，大任务一直等不到空间。
+        """
+        starving = [job_id for job_id in self.pending_jobs if self.is_starving(job_id)]
+        others = sorted((job_id for job_id in self.pending_jobs if job_id not in starving),
+                        key=lambda job_id: self.jobs[job_id]['peak_size'])
+        return starving + others
+
+    def remaining_bytes(self):
+        """排队和下载中任务的剩余字节数（估算）"""
+        remaining = 0
+        for job_id in list(self.pending_jobs) + list(self.active_jobs):
+            job = self.jobs[job_id]
+            downloaded = sum(s[0] for s in job['stats'].values())
+            remaining += max(job['estimated_size'] - downloaded, 0)
+        return remaining
+
+    def refresh_schedule(self):
+        """定时按时间段和剩余量调整限速，并在进入时段后启动等待中的任务"""
+        _, message = self.scheduler.update(self.remaining_bytes())
+        if message and message != self.schedule_message:
+            self.update_status(message)
+        self.schedule_message = message
+        self.try_start_jobs()
+
+    def show_schedule_estimate(self):
+        """预估当前队列按时间段和限速何时能完成"""
+        QMessageBox.information(self, '排期预估', self.scheduler.estimate(self.remaining_bytes()))
+
+    def start_job(self, job_id):
+        """创建并启动任务的下载线程"""
+        job = self.jobs[job_id]
+        urls, paths = job['urls'], job['paths']
+        if job['clip']:
+            start, end = job['clip']
+            workers = [ClipWorker(urls['video_stream'], urls['audio_stream'], paths, start, end,
+                                  url_resolvers=job['resolvers'])]
+            self.status_text.append(f"开始截取片段 {start:.1f}s - {end:.1f}s: {job['title']}")
+        elif job['parts']:
+            part = job['parts'][job['part_index']]
+            # 还没开始的分P按估算大小计入总量，进度不会随分P切换跳动
+            job['pending_size'] = sum(p['size'] for p in job['parts'][job['part_index'] + 1:])
+            workers = [
+                DownloadWorker(part['urls']['video_url'], part['paths']['video_path'],
+                               f"{part['label']}视频流", part['resolvers'][0]),
+                DownloadWorker(part['urls']['audio_url'], part['paths']['audio_path'],
+                               f"{part['label']}音频流", part['resolvers'][1])
+            ]
+            self.status_text.append(f"开始下载{part['label']}: {job['title']}")
         else:
-            self.audio_progress.setValue(progress)
+            workers = [
+                DownloadWorker(urls['video_url'], paths['video_path'], "视频流", job['resolvers'][0]),
+                DownloadWorker(urls['audio_url'], paths['audio_path'], "音频流", job['resolvers'][1])
+            ]
+            self.status_text.append(f"开始下载到: {os.path.dirname(paths['output_path'])}")
+
+        # 弹幕和字幕与视频流同时下载
+        sources = self.danmaku_sources(job)
+        if sources:
+            part_files = [part['paths']['video_path'] for part in job['parts']] if job['parts'] else None
+            workers.append(DanmakuWorker(self.api, job['aid'], sources, job['paths']['output_path'],
+                                         part_files=part_files))
+
+        job['tracer'].begin()
+        for worker in workers:
+            # 工作线程中的各个阶段记录到任务的时间线
+            worker.tracer = job['tracer']
+            worker.status_updated.connect(self.update_status)
+            worker.stats_updated.connect(
+                lambda desc, downloaded, total, speed, job_id=job_id: self.update_job_stats(
+                    job_id, desc, downloaded, total, speed
+                )
+            )
+            worker.download_completed.connect(
+                lambda success, desc, job_id=job_id: self.handle_download_completed(job_id, success, desc)
+            )
+            # 线程真正结束后才释放引用，避免线程运行中被回收
+            worker.finished.connect(lambda job=job, worker=worker: job['workers'].remove(worker))
+        job['workers'] += workers
+        job['stream_count'] = len(workers)
+        self.active_jobs.add(job_id)
+        self.download_table.model.update_job(job_id, stage='下载中')
+        for worker in workers:
+            worker.start()
+
+    def danmaku_sources(self, job):
+        """需要导出弹幕的 [(cid, 时长, 起始秒数)]，不需要导出时返回None
+
+        合并分P的任务随最后一个分P一起导出全部分P的弹幕，按分P时长依次偏移，和章节对齐；
+        这时前面的分P已经下载完，DanmakuWorker 会按文件的实际时长修正偏移。
+        """
+        if not self.danmaku_enabled or job['clip']:
+            return None
+        if not job['parts']:
+            return [(job['cid'], job['urls']['duration'], 0)]
+        if job['part_index'] != len(job['parts']) - 1:
+            return None
+        sources = []
+        offset = 0
+        for part in job['parts']:
+            sources.append((part['cid'], part['duration'], offset))
+            offset += part['duration']
+        return sources
+
+    def update_job_stats(self, job_id, desc, downloaded, total, speed):
+        """汇总任务中各个流的进度，更新任务列表"""
+        job = self.jobs[job_id]
+        job['stats'][desc] = (downloaded, total, speed)
+        downloaded = sum(s[0] for s in job['stats'].values())
+        # 已写入的部分已经占用了磁盘，预留中只保留还没写入的部分
+        self.disk_budget.update(job_id, job['peak_size'] - downloaded)
+        total = sum(s[1] for s in job['stats'].values()) + job['pending_size']
+        speed = sum(s[2] for s in job['stats'].values())
+        self.download_table.model.update_job(
+            job_id,
+            progress=int(downloaded / total * 100) if total > 0 else 0,
+            speed=speed,
+            eta=(total - downloaded) / speed if speed > 0 else None,
+            size=total
+        )
 
     def update_status(self, message):
         """更新状态信息"""
         self.status_text.append(message)
 
-    def handle_download_completed(self, success, desc, video_path, audio_path, output_path):
+    def handle_download_completed(self, job_id, success, desc):
         """处理下载完成事件"""
-        if desc == "视频流":
-            self.video_downloaded = success
+        job = self.jobs[job_id]
+        job['finished'][desc] = success
+        if len(job['finished']) < job['stream_count']:
+            return
+
+        if not all(job['finished'].values()):
+            self.finish_job(job_id, False)
+            return
+
+        if job['clip']:
+            # 片段任务在工作线程中已经合并完成
+            self.finish_job(job_id, True, job['paths']['output_path'])
+            return
+
+        if job['parts']:
+            # 分P按顺序下载，前面的分P先完成；全部下载完后一次流复制拼接
+            job['stats'] = {desc: (downloaded, total, 0.0) for desc, (downloaded, total, _) in job['stats'].items()}
+            if job['part_index'] + 1 < len(job['parts']):
+                job['part_index'] += 1
+                job['finished'] = {}
+                self.start_job(job_id)
+                return
+            self.download_table.model.update_job(job_id, stage='合并中', speed=0.0, eta=None)
+            parts = [(part['paths']['video_path'], part['paths']['audio_path'], part['title'], part['duration'])
+                     for part in job['parts']]
+            # 整个系列的拼接耗时较长，放到后台线程中进行
+            self.output_runner.submit(
+                None, self.concat_job, job_id, parts,
+                on_done=lambda result: self.handle_merge_finished(job_id, result),
+                on_error=lambda message: self.handle_merge_finished(job_id, (False, message))
+            )
+            return
+
+        self.download_table.model.update_job(job_id, stage='合并中', speed=0.0, eta=None)
+        # 合并大文件时 ffmpeg 要运行一段时间，放到后台线程中，不阻塞界面
+        self.output_runner.submit(
+            None, self.merge_job, job_id,
+            on_done=lambda result: self.handle_merge_finished(job_id, result),
+            on_error=lambda message: self.handle_merge_finished(job_id, (False, message))
+        )
+
+    def merge_job(self, job_id):
+        """（后台线程）合并音视频并清理临时文件"""
+        job = self.jobs[job_id]
+        video_path, audio_path = job['paths']['video_path'], job['paths']['audio_path']
+        with job['tracer'].activate():
+            success, message = merge_video_audio(video_path, audio_path, job['paths']['output_path'])
+
+        # 清理临时文件
+        try:
+            if os.path.exists(video_path):
+                os.remove(video_path)
+            if os.path.exists(audio_path):
+                os.remove(audio_path)
+            message += "\n临时文件清理完成"
+        except Exception as e:
+            message += f"\n清理临时文件失败: {str(e)}"
+        return success, message
+
+    def concat_job(self, job_id, parts):
+        """（后台线程）拼接所有分P"""
+        job = self.jobs[job_id]
+        with job['tracer'].activate():
+            return concat_parts(parts, job['paths']['output_path'])
+
+    def handle_merge_finished(self, job_id, result):
+        """合并或分P拼接结束"""
+        success, message = result
+        self.update_status(message)
+        self.finish_job(job_id, success, self.jobs[job_id]['paths']['output_path'])
+
+    def finish_job(self, job_id, success, output_path=None):
+        """下载结束，释放名额并启动下一个任务；配置了后处理时交给后处理进程池"""
+        self.active_jobs.discard(job_id)
+        self.disk_budget.release(job_id)
+        trace_path = self.jobs[job_id]['tracer'].finish()
+        if trace_path:
+            self.update_status(f"任务时间线已保存: {trace_path}")
+        if success and self.post_processor:
+            self.download_table.model.update_job(job_id, stage='后处理中', progress=0, speed=0.0, eta=None)
+            self.post_processor.submit(
+                output_path,
+                on_progress=lambda percent: self.post_signals.progress.emit(job_id, percent),
+                on_done=lambda ok, message: self.post_signals.finished.emit(job_id, ok, message)
+            )
+        elif success:
+            self.deliver_job(job_id)
         else:
-            self.audio_downloaded = success
+            self.download_table.model.update_job(job_id, stage='失败', speed=0.0, eta=None)
+        self.try_start_jobs()
 
-        if self.video_downloaded and self.audio_downloaded:
-            success, message = merge_video_audio(video_path, audio_path, output_path)
-            self.update_status(message)
+    def handle_post_process_finished(self, job_id, success, message):
+        """后处理结束"""
+        self.update_status(message)
+        if success:
+            self.deliver_job(job_id)
+        else:
+            self.download_table.model.update_job(job_id, stage='失败', progress=0)
 
-            # 清理临时文件
-            try:
-                if os.path.exists(video_path):
-                    os.remove(video_path)
-                if os.path.exists(audio_path):
-                    os.remove(audio_path)
-                self.update_status("临时文件清理完成")
-            except Exception as e:
-                self.update_status(f"清理临时文件失败: {str(e)}")
+    def deliver_job(self, job_id):
+        """把完成的文件交付到配置的输出位置（归档或对象存储），在后台线程中进行"""
+        if is_passthrough(self.sink):
+            self.download_table.model.update_job(job_id, stage='完成', progress=100, speed=0.0, eta=None)
+            return
+        output_path = self.jobs[job_id]['paths']['output_path']
+        self.download_table.model.update_job(job_id, stage='上传中', speed=0.0, eta=None)
+        self.output_runner.submit(
+            None, deliver_outputs, self.sink, output_path,
+            on_done=lambda result: self.handle_delivered(job_id, result),
+            on_error=lambda message: self.handle_delivered(job_id, ([], message))
+        )
+
+    def handle_delivered(self, job_id, result):
+        """交付结束"""
+        locations, error = result
+        if error:
+            self.update_status(error)
+            self.download_table.model.update_job(job_id, stage='失败')
+            return
+        for location in locations:
+            self.update_status(f"已保存至: {location}")
+        self.download_table.model.update_job(job_id, stage='完成', progress=100)
 
-            self.download_btn.setEnabled(True)
-            self.video_downloaded = False
-            self.audio_downloaded = False
+    def closeEvent(self, event):
+        """关闭窗口时等待后处理进程结束"""
+        if self.post_processor:
+            self.post_processor.shutdown()
+        super().closeEvent(event)
 
 
 if __name__ == '__main__':
+    # 打包成exe后，后处理进程池的子进程需要这一步
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     # 设置应用程序图标
     app.setWindowIcon(QIcon(resource_path('app.ico')))
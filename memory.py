@@ -0,0 +1,70 @@
+import threading
+from contextlib import contextmanager
+
+from config import load_config
+
+
+class BufferPool:
+    """全局共享的可复用I/O缓冲区池
+
+    总内存 = 缓冲区大小 × 缓冲区数量，不会随下载数量增长。
+    每个下载流最多占用 buffers_per_stream 个缓冲区，
+    同时运行的流数量由 stream_slot 控制，保证池子不会被借空。
+    """
+
+    def __init__(self, buffer_size, budget_bytes, buffers_per_stream):
+        self.buffer_size = buffer_size
+        self.total_buffers = max(budget_bytes // buffer_size, buffers_per_stream)
+        self.max_streams = max(self.total_buffers // buffers_per_stream, 1)
+        self.free_buffers = []
+        self.allocated = 0
+        self.condition = threading.Condition()
+        self.stream_semaphore = threading.BoundedSemaphore(self.max_streams)
+
+    def acquire(self):
+        """借出一个缓冲区，用完了就等待归还"""
+        with self.condition:
+            while not self.free_buffers and self.allocated >= self.total_buffers:
+                self.condition.wait()
+            if self.free_buffers:
+                return self.free_buffers.pop()
+            # 按需分配，没有下载时不占用预算内存
+            self.allocated += 1
+            return bytearray(self.buffer_size)
+
+    def release(self, buffer):
+        """归还缓冲区"""
+        with self.condition:
+            self.free_buffers.append(buffer)
+            self.condition.notify()
+
+    @contextmanager
+    def stream_slot(self, on_wait=None):
+        """占用一个下载流名额，名额用完时阻塞等待（准入控制）"""
+        if not self.stream_semaphore.acquire(blocking=False):
+            if on_wait:
+                on_wait()
+            self.stream_semaphore.acquire()
+        try:
+            yield
+        finally:
+            self.stream_semaphore.release()
+
+
+_buffer_pool = None
+_buffer_pool_lock = threading.Lock()
+
+
+def get_buffer_pool():
+    """获取全局缓冲区池，按配置的内存预算创建"""
+    global _buffer_pool
+    with _buffer_pool_lock:
+        if _buffer_pool is None:
+            config = load_config()
+            _buffer_pool = BufferPool(
+                config['download']['chunk_size'],
+                config['memory']['budget_mb'] * 1024 * 1024,
+                # 队列中的块 + 写入线程取出的一批（最多一整个队列） + 正在读取的块
+                config['download']['write_queue_size'] * 2 + 1
+            )
+        return _buffer_pool
@@ -0,0 +1,119 @@
+import os
+import time
+import shutil
+import threading
+
+from config import load_config
+from scheduler import MB, estimate_stream_bytes
+
+# 码率估算偏小时留出的余量
+ESTIMATE_MARGIN = 1.05
+# 流复制合并时输出文件约等于两个输入之和，合并期间临时文件和输出同时存在
+MERGE_OVERHEAD = 1.0
+
+
+def probe_stream_size(session, url, headers, timeout):
+    """用 Range: bytes=0-0 请求探测文件大小，失败时返回0"""
+    try:
+        response = session.get(url, headers={**headers, 'Range': 'bytes=0-0'}, timeout=timeout, stream=True)
+        response.close()
+    except Exception:
+        return 0
+    # Content-Range: bytes 0-0/12345
+    content_range = response.headers.get('Content-Range', '')
+    total = content_range.rsplit('/', 1)[-1]
+    if response.status_code == 206 and total.isdigit():
+        return int(total)
+    if response.status_code == 200:
+        return int(response.headers.get('Content-Length', 0))
+    return 0
+
+
+def estimate_sizes(api, urls, probe=None):
+    """估算视频流和音频流的字节数，返回 {'video_stream': 字节数, 'audio_stream': 字节数}
+
+    优先使用DASH码率×时长，没有码率或配置了探测时用Range请求获取准确大小。
+    """
+    if probe is None:
+        probe = load_config()['download']['probe_size']
+    sizes = {}
+    for kind in ('video_stream', 'audio_stream'):
+        stream = urls[kind]
+        size = 0
+        if probe or not stream.get('bandwidth'):
+            size = probe_stream_size(api.session, stream['baseUrl'], api.headers, api.timeout)
+        if not size:
+            size = int(estimate_stream_bytes(stream, urls['duration']) * ESTIMATE_MARGIN)
+        sizes[kind] = size
+    return sizes
+
+
+def peak_disk_usage(download_bytes):
+    """任务占用磁盘的峰值：临时 .m4s 文件加上合并输出"""
+    return int(download_bytes * (1 + MERGE_OVERHEAD))
+
+
+class DiskBudget:
+    """按剩余磁盘空间放行任务
+
+    已放行的任务还没写入磁盘的部分也计为占用，剩余空间扣除这些预留后仍高于保留量时才放行新任务，
+    避免一批大任务同时写到一半把磁盘占满。
+    """
+
+    def __init__(self, reserve_bytes=None):
+        if reserve_bytes is None:
+            reserve_bytes = load_config()['download']['disk_reserve_mb'] * MB
+        self.reserve = reserve_bytes
+        self.lock = threading.Lock()
+        self.reserved = {}  # key -> [所在设备, 尚未写入的字节数]
+
+    def available(self, directory):
+        """可以分配给新任务的字节数"""
+        device = os.stat(directory).st_dev
+        pending = sum(size for dev, size in self.reserved.values() if dev == device)
+        return shutil.disk_usage(directory).free - pending - self.reserve
+
+    def is_idle(self, directory):
+        """同一磁盘上是否没有已放行的任务"""
+        device = os.stat(directory).st_dev
+        return not any(dev == device for dev, _ in self.reserved.values())
+
+    def try_reserve(self, key, directory, size):
+        """空间足够时为任务预留 size 字节，返回是否放行"""
+        with self.lock:
+            if self.available(directory) < size:
+                return False
+            self.reserved[key] = [os.stat(directory).st_dev, size]
+            return True
+
+    def wait_reserve(self, key, directory, size, poll_interval=5):
+        """阻塞直到空间足够，其他任务结束后仍不够时返回False（命令行同步时使用）"""
+        while not self.try_reserve(key, directory, size):
+            with self.lock:
+                if self.is_idle(directory):
+                    return False
+            time.sleep(poll_interval)
+        return True
+
+    def update(self, key, remaining):
+        """任务写入一部分后更新剩余预留，已写入的部分已经反映在磁盘剩余空间中"""
+        with self.lock:
+            if key in self.reserved:
+                self.reserved[key][1] = max(remaining, 0)
+
+    def release(self, key):
+        with self.lock:
+            self.reserved.pop(key, None)
+
+
+_disk_budget = None
+_disk_budget_lock = threading.Lock()
+
+
+def get_disk_budget():
+    """全局磁盘预算，界面和命令行同步共用"""
+    global _disk_budget
+    with _disk_budget_lock:
+        if _disk_budget is None:
+            _disk_budget = DiskBudget()
+        return _disk_budget
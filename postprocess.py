@@ -0,0 +1,153 @@
+import os
+import json
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from config import load_config
+from process import run_ffmpeg
+
+
+def stage_outputs(stage, input_path, settings):
+    """各处理阶段的输出文件和ffmpeg输出参数"""
+    base, _ = os.path.splitext(input_path)
+    if stage == 'transcode':
+        options = settings['transcode']
+        args = ['-map', '0:v:0', '-map', '0:a:0?',
+                '-c:v', options['video_codec'], '-preset', options['preset'], '-crf', str(options['crf']),
+                '-c:a', options['audio_codec']]
+        return f"{base}_transcoded.mp4", args
+    elif stage == 'loudnorm':
+        args = ['-map', '0:v:0', '-map', '0:a:0', '-c:v', 'copy',
+                '-af', settings['loudnorm']['filter'], '-c:a', settings['transcode']['audio_codec']]
+        return f"{base}_loudnorm.mp4", args
+    elif stage == 'thumbnail':
+        args = ['-map', '0:v:0', '-vf', f"thumbnail=300,scale={settings['thumbnail']['width']}:-2",
+                '-frames:v', '1', '-update', '1']
+        return f"{base}_thumb.jpg", args
+    elif stage == 'extract_audio':
+        args = ['-map', '0:a:0', '-vn', '-c:a', 'copy']
+        return f"{base}_audio.m4a", args
+    raise ValueError(f"未知的处理阶段: {stage}")
+
+
+def build_command(input_path, stages, settings):
+    """把多个阶段合成一次ffmpeg调用：一个输入、多个输出，源文件只读一遍
+
+    同时有转码和响度标准化时，响度标准化直接作为转码的音频滤镜，不再单独输出。
+    返回 (ffmpeg参数, {阶段: 输出文件})
+    """
+    outputs = {}
+    args = ['-y', '-i', input_path]
+    for stage in stages:
+        if stage == 'loudnorm' and 'transcode' in stages:
+            continue
+        output_path, stage_args = stage_outputs(stage, input_path, settings)
+        if stage == 'transcode' and 'loudnorm' in stages:
+            stage_args += ['-af', settings['loudnorm']['filter']]
+            outputs['loudnorm'] = output_path
+        outputs[stage] = output_path
+        if settings['threads_per_job']:
+            stage_args += ['-threads', str(settings['threads_per_job'])]
+        args += stage_args + [output_path]
+    return args, outputs
+
+
+def state_path(input_path):
+    return f"{input_path}.postprocess.json"
+
+
+def load_state(input_path):
+    """读取已完成的阶段，用于失败后从未完成的阶段继续"""
+    try:
+        with open(state_path(input_path), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def run_pipeline(input_path, stages, settings, progress_queue=None):
+    """（子进程）对一个文件执行后处理，返回 (是否成功, 信息)"""
+    done = load_state(input_path)
+    pending = [stage for stage in stages if not (stage in done and os.path.exists(done[stage]))]
+    if not pending:
+        return True, f"后处理已完成: {os.path.basename(input_path)}"
+
+    def on_progress(seconds, total):
+        if progress_queue is not None and total:
+            progress_queue.put((input_path, min(int(seconds / total * 100), 100)))
+
+    def save_state(outputs):
+        done.update(outputs)
+        with open(state_path(input_path), 'w', encoding='utf-8') as f:
+            json.dump(done, f, ensure_ascii=False, indent=2)
+
+    args, outputs = build_command(input_path, pending, settings)
+    success, stderr = run_ffmpeg(args, on_progress=on_progress)
+    if success:
+        save_state(outputs)
+        return True, f"后处理完成({', '.join(pending)}): {os.path.basename(input_path)}"
+    if len(pending) == 1:
+        return False, f"后处理失败({pending[0]}): {stderr}"
+
+    # 合并执行失败时逐个阶段重试，成功的阶段记录下来，下次只重做失败的阶段
+    failed = []
+    for stage in pending:
+        args, outputs = build_command(input_path, [stage], settings)
+        success, stderr = run_ffmpeg(args, on_progress=on_progress)
+        if success:
+            save_state(outputs)
+        else:
+            failed.append(f"{stage}: {stderr}")
+    if failed:
+        return False, "后处理失败\n" + "\n".join(failed)
+    return True, f"后处理完成({', '.join(pending)}): {os.path.basename(input_path)}"
+
+
+class PostProcessor:
+    """在进程池中并行执行后处理，进程数默认等于CPU核数"""
+
+    def __init__(self, stages=None):
+        self.settings = load_config()['postprocess']
+        self.stages = stages if stages is not None else self.settings['stages']
+        workers = self.settings['workers'] or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.manager = multiprocessing.Manager()
+        self.progress_queue = self.manager.Queue()
+        self.progress_callbacks = {}
+        self.pump = threading.Thread(target=self.pump_progress, daemon=True)
+        self.pump.start()
+
+    def submit(self, input_path, on_progress=None, on_done=None):
+        """提交一个文件，on_progress(百分比)、on_done(是否成功, 信息) 在后台线程中调用"""
+        if on_progress:
+            self.progress_callbacks[input_path] = on_progress
+        future = self.executor.submit(run_pipeline, input_path, self.stages, self.settings, self.progress_queue)
+
+        def finished(future):
+            self.progress_callbacks.pop(input_path, None)
+            if on_done:
+                try:
+                    on_done(*future.result())
+                except Exception as e:
+                    on_done(False, f"后处理出错: {str(e)}")
+
+        future.add_done_callback(finished)
+        return future
+
+    def pump_progress(self):
+        """把子进程上报的进度转给回调"""
+        while True:
+            item = self.progress_queue.get()
+            if item is None:
+                return
+            input_path, percent = item
+            callback = self.progress_callbacks.get(input_path)
+            if callback:
+                callback(percent)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.progress_queue.put(None)
+        self.pump.join()
+        self.manager.shutdown()
@@ -0,0 +1,77 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from requests.adapters import HTTPAdapter
+
+from config import load_config
+from ratelimit import RateLimiter
+
+
+class MetadataPrefetcher:
+    """并发预取视频信息和下载链接
+
+    同一个BV正在解析时，重复提交或并发提交共用同一个 Future；解析结束后即移除，
+    之后再提交会重新解析，失败的BV可以重试，记录也不会随提交数量一直增长。
+    """
+
+    def __init__(self, api, concurrency=None, rate_limit=None, quality=None):
+        settings = load_config()['prefetch']
+        self.api = api
+        self.concurrency = concurrency or settings['concurrency']
+        self.quality = quality or settings['quality']
+        self.limiter = RateLimiter(rate_limit if rate_limit is not None else settings['rate_limit'])
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        # 连接池大小与并发数一致，避免多余的连接被丢弃重建
+        adapter = HTTPAdapter(pool_connections=self.concurrency, pool_maxsize=self.concurrency)
+        self.api.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.futures = {}  # 正在解析的BV -> Future
+
+    def submit(self, bv_number):
+        """提交一个BV，返回对应的 Future"""
+        bv_number = bv_number.strip()
+        with self.lock:
+            future = self.futures.get(bv_number)
+            if future is not None:
+                return future
+            future = self.executor.submit(self.resolve, bv_number)
+            self.futures[bv_number] = future
+        # 已经完成时回调会在当前线程立即执行，所以在锁外注册
+        future.add_done_callback(lambda future: self.forget(bv_number, future))
+        return future
+
+    def forget(self, bv_number, future):
+        """解析结束后移除记录"""
+        with self.lock:
+            if self.futures.get(bv_number) is future:
+                del self.futures[bv_number]
+
+    def resolve(self, bv_number):
+        """解析单个BV的视频信息和所有分P的下载链接"""
+        result = {'bvid': bv_number, 'info': None, 'urls': {}, 'quality': self.quality, 'error': None}
+
+        self.limiter.acquire()
+        info, error = self.api.get_video_info(bv_number)
+        if error:
+            result['error'] = error
+            return result
+        result['info'] = info
+
+        for page in info.get('pages', []):
+            self.limiter.acquire()
+            urls, error = self.api.get_download_urls(info['aid'], page['cid'], self.quality)
+            if error:
+                result['error'] = f"P{page['page']}: {error}"
+                return result
+            result['urls'][page['cid']] = urls
+        return result
+
+    def prefetch(self, bv_numbers):
+        """按完成顺序逐个产出解析结果，先解析完的可以先开始下载"""
+        unique = {self.submit(bv_number) for bv_number in bv_numbers}
+        for future in as_completed(unique):
+            yield future.result()
+
+    def shutdown(self, wait=True):
+        """关闭线程池"""
+        self.executor.shutdown(wait=wait)
@@ -1,62 +1,250 @@
 import os
+import re
+import subprocess
+import threading
+from collections import deque
 from imageio_ffmpeg import get_ffmpeg_exe
 
+from tracing import traced
 
+DURATION_PATTERN = re.compile(r'Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)')
+
+
+def decode_output(data):
+    """尝试不同的编码方式解码ffmpeg输出"""
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        try:
+            return data.decode('gbk')
+        except UnicodeDecodeError:
+            return str(data)
+
+
+def parse_duration(line):
+    """从ffmpeg输出的 'Duration: 00:01:02.03' 中解析秒数"""
+    match = DURATION_PATTERN.search(line)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def run_ffmpeg(args, tail_lines=50, on_progress=None):
+    """运行ffmpeg，返回 (是否成功, 错误输出)
+
+    stderr 逐行读取，只保留最后 tail_lines 行，长时间运行时内存不会随输出增长。
+    传入 on_progress 时通过 -progress 读取进度，回调参数为 (已处理秒数, 总秒数或None)。
+    """
+    ffmpeg_path = get_ffmpeg_exe()  # 自动获取ffmpeg路径
+    # -nostats 关闭以\r刷新的进度行，避免单行无限变长
+    cmd = [ffmpeg_path, '-hide_banner', '-nostats']
+    if on_progress:
+        cmd += ['-progress', 'pipe:1']
+    cmd += list(args)
+
+    # 创建 startupinfo 对象（Windows下隐藏控制台窗口）
+    startupinfo = None
+    if os.name == 'nt':
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        startupinfo.wShowWindow = subprocess.SW_HIDE
+
+    process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE if on_progress else subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        startupinfo=startupinfo,
+        text=False  # 使用二进制模式
+    )
+
+    tail = deque(maxlen=tail_lines)
+    duration = []
+
+    def read_stderr():
+        for line in process.stderr:
+            line = decode_output(line.rstrip())
+            if not duration and 'Duration:' in line:
+                seconds = parse_duration(line)
+                if seconds:
+                    duration.append(seconds)
+            tail.append(line)
+
+    if on_progress:
+        # stderr 放到单独线程读取，避免两个管道互相阻塞
+        stderr_thread = threading.Thread(target=read_stderr, daemon=True)
+        stderr_thread.start()
+        for line in process.stdout:
+            key, _, value = line.decode('ascii', 'ignore').strip().partition('=')
+            if key == 'out_time_us' and value.isdigit():
+                on_progress(int(value) / 1000000, duration[0] if duration else None)
+        process.stdout.close()
+        stderr_thread.join()
+    else:
+        read_stderr()
+    process.stderr.close()
+    process.wait()
+
+    return process.returncode == 0, '\n'.join(tail)
+
+
+def probe_duration(path):
+    """读取媒体文件的实际时长（秒），读取失败时返回None"""
+    try:
+        # 只有输入没有输出时ffmpeg会报错退出，但已经输出了文件信息
+        _, output = run_ffmpeg(['-i', path])
+    except Exception:
+        return None
+    return parse_duration(output)
+
+
+def part_offsets(parts):
+    """各分P在拼接后文件中的起始秒数，parts 为 [(视频文件, 页面信息中的时长)]
+
+    页面信息中的时长只精确到秒，误差会逐P累积，所以优先用文件的实际时长；
+    最后一个分P的时长不影响起始位置，不需要读取。文件读取失败时退回页面时长。
+    """
+    offsets = []
+    offset = 0
+    for path, duration in parts:
+        offsets.append(offset)
+        if len(offsets) < len(parts):
+            offset += probe_duration(path) or duration
+    return offsets
+
+
+def remove_temp_files(*paths):
+    """删除临时文件"""
+    try:
+        for path in paths:
+            os.remove(path)
+    except Exception as e:
+        print(f"删除临时文件失败: {str(e)}")  # 仅打印错误，不影响主流程
+
+
+@traced('merge', 'process')
 def merge_video_audio(video_path, audio_path, output_path):
     """合并视频和音频"""
     try:
-        ffmpeg_path = get_ffmpeg_exe()  # 自动获取ffmpeg路径
-        import subprocess
-
-        cmd = [
-            ffmpeg_path,
+        success, stderr = run_ffmpeg([
             '-i', video_path,
             '-i', audio_path,
             '-c', 'copy',
             '-y',  # 自动覆盖输出文件
             output_path
-        ]
-
-        # 创建 startupinfo 对象（Windows下隐藏控制台窗口）
-        startupinfo = None
-        if os.name == 'nt':
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            startupinfo.wShowWindow = subprocess.SW_HIDE
-
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            startupinfo=startupinfo,
-            text=False  # 使用二进制模式
-        )
-
-        # 获取输出并正确处理编码
-        stdout, stderr = process.communicate()
-
-        # 尝试不同的编码方式解码输出
-        try:
-            stderr = stderr.decode('utf-8') if stderr else ''
-        except UnicodeDecodeError:
-            try:
-                stderr = stderr.decode('gbk') if stderr else ''
-            except UnicodeDecodeError:
-                stderr = str(stderr) if stderr else ''
-
-        if process.returncode == 0:
-            # 删除临时文件
-            try:
-                os.remove(video_path)
-                os.remove(audio_path)
-            except Exception as e:
-                print(f"删除临时文件失败: {str(e)}")  # 仅打印错误，不影响主流程
+        ])
+
+        if success:
+            remove_temp_files(video_path, audio_path)
             return True, '视频合并完成'
         else:
             return False, f'合并失败: {stderr}'
 
     except Exception as e:
         return False, f'合并过程出错: {str(e)}'
+
+
+@traced('merge_clip', 'process')
+def merge_clip(video_path, audio_path, output_path, video_offset, audio_offset, duration):
+    """合并片段的视频和音频
+
+    输入是只包含部分分片的fMP4，时间戳按分片重新从0开始计算（-use_tfdt 0），
+    offset 是片段起点相对于首个分片的秒数。使用流复制，起点会落在之前最近的关键帧。
+    """
+    try:
+        success, stderr = run_ffmpeg([
+            '-use_tfdt', '0', '-ss', f'{video_offset:.3f}', '-i', video_path,
+            '-use_tfdt', '0', '-ss', f'{audio_offset:.3f}', '-i', audio_path,
+            '-t', f'{duration:.3f}',
+            '-map', '0:v:0', '-map', '1:a:0',
+            '-c', 'copy',
+            '-y',
+            output_path
+        ])
+
+        if success:
+            remove_temp_files(video_path, audio_path)
+            return True, '片段合并完成'
+        else:
+            return False, f'片段合并失败: {stderr}'
+
+    except Exception as e:
+        return False, f'片段合并过程出错: {str(e)}'
+
+
+def escape_metadata(text):
+    """转义 ffmetadata 中的特殊字符"""
+    for char in ('\\', '=', ';', '#', '\n'):
+        text = text.replace(char, '\\' + char)
+    return text
+
+
+def write_concat_list(path, files, durations=None):
+    """写入 concat 分离器使用的文件列表
+
+    给出 durations 时为除最后一个以外的文件写入 outpoint 和 duration，下一个文件按这个时长接上，
+    而不是按文件自身的时长。
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        for index, file in enumerate(files):
+            escaped = os.path.abspath(file).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+            if durations and index < len(files) - 1:
+                f.write(f"outpoint {durations[index]:.6f}\nduration {durations[index]:.6f}\n")
+
+
+def write_chapters(path, chapters):
+    """写入 ffmetadata 章节文件，chapters 为 [(标题, 时长秒数)]"""
+    lines = [';FFMETADATA1']
+    start = 0
+    for title, duration in chapters:
+        end = start + int(duration * 1000)
+        lines += ['[CHAPTER]', 'TIMEBASE=1/1000', f'START={start}', f'END={end}', f'title={escape_metadata(title)}']
+        start = end
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+@traced('concat', 'process')
+def concat_parts(parts, output_path):
+    """把多个分P拼接成一个文件，并按分P标题写入章节
+
+    parts 为 [(视频文件, 音频文件, 标题, 时长秒数)]。所有分P的视频流和音频流各作为一个
+    concat 输入，一次流复制写出，不生成每个分P单独的MP4。各分P按视频文件的实际时长划分章节，
+    读取不到时用 parts 中的时长。同一分P的音频和视频长度往往差几十毫秒，两个输入都按这个时长
+    接上下一个分P，否则误差逐P累积，后面的分P音画不同步。
+    """
+    base, _ = os.path.splitext(output_path)
+    video_list, audio_list, chapters = f"{base}_video.txt", f"{base}_audio.txt", f"{base}_chapters.txt"
+    try:
+        durations = [probe_duration(part[0]) or part[3] for part in parts]
+        write_concat_list(video_list, [part[0] for part in parts], durations)
+        write_concat_list(audio_list, [part[1] for part in parts], durations)
+        write_chapters(chapters, [(part[2], duration) for part, duration in zip(parts, durations)])
+        success, stderr = run_ffmpeg([
+            '-f', 'concat', '-safe', '0', '-i', video_list,
+            '-f', 'concat', '-safe', '0', '-i', audio_list,
+            '-i', chapters,
+            '-map', '0:v:0', '-map', '1:a:0',
+            '-map_metadata', '2', '-map_chapters', '2',
+            '-c', 'copy',
+            '-y',
+            output_path
+        ])
+
+        if success:
+            for part in parts:
+                remove_temp_files(part[0], part[1])
+            return True, f'{len(parts)}个分P合并完成'
+        else:
+            return False, f'分P合并失败: {stderr}'
+
+    except Exception as e:
+        return False, f'分P合并过程出错: {str(e)}'
+    finally:
+        remove_temp_files(*[path for path in (video_list, audio_list, chapters) if os.path.exists(path)])
+
+
 def get_video_quality():
     return {
         116: '高清 1080P60',
@@ -65,4 +253,3 @@ def get_video_quality():
         32: '清晰 480P',
         16: '流畅 360P'
     }
-
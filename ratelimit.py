@@ -0,0 +1,57 @@
+import time
+import threading
+
+
+class RateLimiter:
+    """线程安全的令牌桶限速器
+
+    rate 为每秒补充的令牌数，rate 为 0 或 None 表示不限速。
+    暂停（pause）时所有 acquire 都会阻塞，直到恢复（resume）。
+    """
+
+    def __init__(self, rate, burst=None):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate or 0, 1)
+        self.tokens = self.burst
+        self.last_time = time.monotonic()
+        self.paused = False
+
+    def set_rate(self, rate, burst=None):
+        """修改限速，已等待的线程会在下次检查时使用新速率"""
+        with self.lock:
+            self.rate = rate
+            self.burst = burst if burst is not None else max(rate or 0, 1)
+            self.tokens = min(self.tokens, self.burst)
+
+    def pause(self):
+        """暂停放行，正在传输的数据流会在下一次 acquire 时停住"""
+        with self.lock:
+            self.paused = True
+
+    def resume(self):
+        with self.lock:
+            if self.paused:
+                self.paused = False
+                # 暂停期间不积累令牌
+                self.tokens = min(self.tokens, self.burst)
+                self.last_time = time.monotonic()
+
+    def acquire(self, amount=1):
+        """取走 amount 个令牌，不足或暂停时阻塞等待"""
+        while True:
+            with self.lock:
+                if self.paused:
+                    wait_time = 1.0
+                elif not self.rate:
+                    return
+                else:
+                    now = time.monotonic()
+                    self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+                    self.last_time = now
+                    # 单次请求超过桶容量时允许透支，避免永远等不到
+                    if self.tokens >= min(amount, self.burst):
+                        self.tokens -= amount
+                        return
+                    wait_time = (min(amount, self.burst) - self.tokens) / self.rate
+            time.sleep(min(wait_time, 1.0))
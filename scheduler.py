@@ -0,0 +1,170 @@
+import time
+import datetime
+import threading
+
+from config import load_config
+from ratelimit import RateLimiter
+
+MB = 1024 * 1024
+
+
+def parse_clock(text):
+    """把 'HH:MM' 转换为当天的分钟数"""
+    hours, minutes = text.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def estimate_stream_bytes(stream, duration):
+    """按DASH码率估算流大小：bandwidth(bit/s) × 时长 / 8"""
+    return int(stream.get('bandwidth', 0) * duration / 8)
+
+
+class TimeWindow:
+    """每天的一个时间段及其限速，结束时间早于开始时间表示跨过午夜"""
+
+    def __init__(self, start, end, rate_limit_mb=0):
+        self.start = parse_clock(start)
+        self.end = parse_clock(end)
+        self.rate = rate_limit_mb * MB  # 0 表示不限速
+        self.label = f"{start}-{end}"
+
+    def contains(self, moment):
+        minute = moment.hour * 60 + moment.minute
+        if self.start <= self.end:
+            return self.start <= minute < self.end
+        return minute >= self.start or minute < self.end
+
+    def ends_after(self, moment):
+        """从 moment 起到本时段结束的秒数（moment 需在时段内）"""
+        minute = moment.hour * 60 + moment.minute + moment.second / 60
+        remaining = (self.end - minute) % (24 * 60)
+        return remaining * 60 or 24 * 3600
+
+    def starts_after(self, moment):
+        """从 moment 起到本时段下一次开始的秒数"""
+        minute = moment.hour * 60 + moment.minute + moment.second / 60
+        return ((self.start - minute) % (24 * 60)) * 60
+
+
+class Scheduler:
+    """按时间段放行下载任务并调整全局带宽
+
+    没有配置时间段时任务随时开始、不限速。配置了截止时间时，
+    会按剩余字节数和剩余时间计算匀速，让队列刚好在截止前完成，
+    而不是在时段开始时一下子占满带宽。
+    """
+
+    def __init__(self, settings=None):
+        settings = settings or load_config()['schedule']
+        self.windows = [TimeWindow(**window) for window in settings['windows']]
+        self.deadline = parse_clock(settings['deadline']) if settings.get('deadline') else None
+        self.expected_rate = settings['expected_bandwidth_mb'] * MB
+        self.limiter = RateLimiter(0)
+
+    def current_window(self, moment=None):
+        moment = moment or datetime.datetime.now()
+        for window in self.windows:
+            if window.contains(moment):
+                return window
+        return None
+
+    def is_open(self, moment=None):
+        """当前是否允许开始新的下载"""
+        return not self.windows or self.current_window(moment) is not None
+
+    def seconds_to_deadline(self, moment=None):
+        if self.deadline is None:
+            return None
+        moment = moment or datetime.datetime.now()
+        minute = moment.hour * 60 + moment.minute + moment.second / 60
+        return ((self.deadline - minute) % (24 * 60)) * 60 or 24 * 3600
+
+    def iter_open_spans(self, moment, horizon=7 * 24 * 3600):
+        """从 moment 起依次产出可以下载的区间 (开始时间, 秒数, 时段)，最多看 horizon 秒"""
+        end = moment + datetime.timedelta(seconds=horizon)
+        while moment < end:
+            if not self.windows:
+                yield moment, (end - moment).total_seconds(), None
+                return
+            window = self.current_window(moment)
+            if window is None:
+                # 跳到最近的时段开始
+                moment += datetime.timedelta(seconds=min(w.starts_after(moment) for w in self.windows) or 60)
+                continue
+            span = min(window.ends_after(moment), (end - moment).total_seconds())
+            yield moment, span, window
+            moment += datetime.timedelta(seconds=span)
+
+    def open_seconds(self, moment, seconds):
+        """从 moment 起的 seconds 秒内，处于下载时段的总秒数"""
+        return sum(span for _, span, _ in self.iter_open_spans(moment, seconds))
+
+    def update(self, remaining_bytes, moment=None):
+        """根据当前时段和剩余工作量调整全局限速，返回 (限速B/s, 提示信息)"""
+        window = self.current_window(moment)
+        if self.windows and window is None:
+            # 时段外暂停正在进行的传输，而不是取消限速
+            self.limiter.pause()
+            return 0, '不在下载时段内，任务等待中'
+        self.limiter.resume()
+
+        cap = window.rate if window else 0
+        rate = cap
+        message = f"当前时段 {window.label}" if window else ''
+        seconds = self.seconds_to_deadline(moment)
+        if seconds and remaining_bytes > 0:
+            # 只按截止前还能下载的时段时间匀速，时段之间的空档不能算进去
+            seconds = self.open_seconds(moment or datetime.datetime.now(), seconds)
+            # 留10%余量，避免估算偏小导致赶不上截止时间
+            pace = remaining_bytes / seconds * 1.1
+            if cap and pace > cap:
+                message += f"，按当前限速无法在截止时间前完成（需要 {pace / MB:.2f}MB/s）"
+            else:
+                rate = pace
+        self.limiter.set_rate(rate, burst=max(rate, MB) if rate else None)
+        return rate, message
+
+    def estimate(self, total_bytes, moment=None):
+        """预估（不实际下载）：按时间段和限速模拟队列何时完成"""
+        moment = moment or datetime.datetime.now()
+        lines = [f"待下载总量: {total_bytes / MB / 1024:.2f}GB"]
+        remaining = total_bytes
+        # 逐个可下载区间模拟，最多模拟7天
+        for start, span, window in self.iter_open_spans(moment):
+            rate = window.rate if window and window.rate else self.expected_rate
+            amount = min(remaining, rate * span)
+            remaining -= amount
+            if window:
+                lines.append(f"{start:%m-%d %H:%M} 时段 {window.label}: "
+                             f"{amount / MB / 1024:.2f}GB @ {rate / MB:.2f}MB/s")
+            moment = start + datetime.timedelta(seconds=amount / rate)
+            if remaining <= 0:
+                break
+        if remaining > 0:
+            lines.append("7天内无法完成，请检查时间段配置")
+        else:
+            lines.append(f"预计完成时间: {moment:%m-%d %H:%M}")
+            seconds = self.seconds_to_deadline()
+            if seconds is not None:
+                deadline = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+                lines.append("可以在截止时间前完成" if moment <= deadline else
+                             f"无法在截止时间 {deadline:%m-%d %H:%M} 前完成")
+        return '\n'.join(lines)
+
+    def wait_until_open(self, poll_interval=30):
+        """阻塞直到进入下载时段（命令行同步时使用）"""
+        while not self.is_open():
+            time.sleep(poll_interval)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """全局调度器，所有下载共用同一个带宽限速"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+        return _scheduler
@@ -0,0 +1,213 @@
+import os
+import hmac
+import shutil
+import hashlib
+import tarfile
+import zipfile
+import datetime
+import threading
+import requests
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from config import load_config
+from danmaku import export_paths
+from postprocess import load_state, state_path
+
+
+class LocalSink:
+    """保存到本地目录；不指定目录时文件留在下载路径中"""
+
+    def __init__(self, directory=None):
+        self.directory = directory
+
+    def put(self, path, name=None):
+        """交付一个文件，返回 (目标位置, 错误信息)"""
+        if not self.directory:
+            return path, None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            target = os.path.join(self.directory, name or os.path.basename(path))
+            shutil.move(path, target)
+            return target, None
+        except Exception as e:
+            return None, f'移动文件失败: {str(e)}'
+
+
+class ArchiveSink:
+    """追加到 zip 或 tar 归档中，写入后删除本地文件"""
+
+    def __init__(self, path, format='zip', delete_local=True):
+        self.path = path
+        self.format = format
+        self.delete_local = delete_local
+        self.lock = threading.Lock()
+
+    def put(self, path, name=None):
+        name = name or os.path.basename(path)
+        try:
+            with self.lock:
+                if self.format == 'zip':
+                    # 视频本身已压缩，不再压缩以节省CPU
+                    with zipfile.ZipFile(self.path, 'a', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+                        archive.write(path, name)
+                else:
+                    with tarfile.open(self.path, 'a') as archive:
+                        archive.add(path, name)
+            if self.delete_local:
+                os.remove(path)
+            return f"{self.path}:{name}", None
+        except Exception as e:
+            return None, f'写入归档失败: {str(e)}'
+
+
+def hmac_sha256(key, message):
+    return hmac.new(key, message.encode('utf-8'), hashlib.sha256).digest()
+
+
+class S3Sink:
+    """上传到S3兼容的对象存储（AWS S3、MinIO等），大文件并行分片上传
+
+    使用路径风格的地址 (endpoint/bucket/key) 和 AWS Signature V4 签名。
+    """
+
+    def __init__(self, endpoint, bucket, access_key, secret_key, region='us-east-1', prefix='',
+                 part_size=16 * 1024 * 1024, concurrency=4, delete_local=True):
+        self.endpoint = endpoint.rstrip('/')
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix
+        # S3要求除最后一片外每片至少5MB
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.concurrency = concurrency
+        self.delete_local = delete_local
+        self.session = requests.Session()
+
+    def sign(self, method, path, canonical_query, payload_hash):
+        """生成带 Signature V4 签名的请求头"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        date = now.strftime('%Y%m%d')
+        host = self.endpoint.split('://', 1)[-1]
+
+        headers = {'host': host, 'x-amz-content-sha256': payload_hash, 'x-amz-date': amz_date}
+        signed_headers = ';'.join(sorted(headers))
+        canonical_headers = ''.join(f"{k}:{headers[k]}\n" for k in sorted(headers))
+        canonical_request = '\n'.join([method, path, canonical_query, canonical_headers, signed_headers, payload_hash])
+
+        scope = f"{date}/{self.region}/s3/aws4_request"
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, scope,
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+        ])
+        key = hmac_sha256(('AWS4' + self.secret_key).encode('utf-8'), date)
+        for part in [self.region, 's3', 'aws4_request']:
+            key = hmac_sha256(key, part)
+        signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+
+        headers['Authorization'] = (f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+                                    f"SignedHeaders={signed_headers}, Signature={signature}")
+        del headers['host']
+        return headers
+
+    def request(self, method, key, query=None, data=b''):
+        """发送签名请求，失败时抛出异常"""
+        path = '/' + quote(f"{self.bucket}/{key}", safe='/~')
+        # 查询串自己编码，保证和签名时使用的完全一致
+        canonical_query = '&'.join(
+            f"{quote(str(k), safe='~')}={quote(str(v), safe='~')}" for k, v in sorted((query or {}).items())
+        )
+        headers = self.sign(method, path, canonical_query, hashlib.sha256(data).hexdigest())
+        url = self.endpoint + path + (f"?{canonical_query}" if canonical_query else '')
+        response = self.session.request(method, url, data=data, headers=headers, timeout=(10, 300))
+        if response.status_code not in (200, 204):
+            raise Exception(f"S3请求失败 HTTP {response.status_code}: {response.text[:200]}")
+        return response
+
+    def read_part(self, path, part_number):
+        with open(path, 'rb') as f:
+            f.seek((part_number - 1) * self.part_size)
+            return f.read(self.part_size)
+
+    def upload_part(self, path, key, upload_id, part_number):
+        data = self.read_part(path, part_number)
+        response = self.request('PUT', key, {'partNumber': part_number, 'uploadId': upload_id}, data)
+        return part_number, response.headers['ETag']
+
+    def put(self, path, name=None):
+        key = self.prefix + (name or os.path.basename(path))
+        try:
+            size = os.path.getsize(path)
+            if size <= self.part_size:
+                with open(path, 'rb') as f:
+                    self.request('PUT', key, data=f.read())
+            else:
+                self.multipart_upload(path, key, size)
+            if self.delete_local:
+                os.remove(path)
+            return f"s3://{self.bucket}/{key}", None
+        except Exception as e:
+            return None, f'上传失败: {str(e)}'
+
+    def multipart_upload(self, path, key, size):
+        """并行上传各个分片，任何分片失败都会取消整个上传"""
+        response = self.request('POST', key, {'uploads': ''})
+        upload_id = next(el.text for el in ET.fromstring(response.content).iter() if el.tag.endswith('UploadId'))
+        part_count = (size + self.part_size - 1) // self.part_size
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                futures = [executor.submit(self.upload_part, path, key, upload_id, n)
+                           for n in range(1, part_count + 1)]
+                parts = sorted(future.result() for future in futures)
+            body = '<CompleteMultipartUpload>' + ''.join(
+                f'<Part><PartNumber>{n}</PartNumber><ETag>{etag}</ETag></Part>' for n, etag in parts
+            ) + '</CompleteMultipartUpload>'
+            response = self.request('POST', key, {'uploadId': upload_id}, body.encode('utf-8'))
+            # 完成请求即使返回200，出错时正文也可能是Error
+            if b'<Error>' in response.content:
+                raise Exception(response.text[:200])
+        except Exception:
+            try:
+                self.request('DELETE', key, {'uploadId': upload_id})
+            except Exception as e:
+                print(f"取消分片上传失败: {str(e)}")
+            raise
+
+
+def create_sink(settings=None):
+    """根据配置创建输出位置"""
+    settings = settings or load_config()['output']
+    kind = settings['sink']
+    if kind == 'local':
+        return LocalSink(settings['local'].get('directory'))
+    elif kind == 'archive':
+        return ArchiveSink(**settings['archive'])
+    elif kind == 's3':
+        return S3Sink(**settings['s3'])
+    raise ValueError(f"未知的输出类型: {kind}")
+
+
+def deliver_outputs(sink, output_path):
+    """交付视频及其弹幕、字幕和后处理产物，返回 (已交付位置列表, 错误信息)"""
+    paths = [output_path] + export_paths(output_path)
+    for path in load_state(output_path).values():
+        if path not in paths and os.path.exists(path):
+            paths.append(path)
+
+    locations = []
+    for path in paths:
+        location, error = sink.put(path)
+        if error:
+            return locations, error
+        locations.append(location)
+    if os.path.exists(state_path(output_path)):
+        os.remove(state_path(output_path))
+    return locations, None
+
+
+def is_passthrough(sink):
+    """是否无需交付（文件直接留在下载路径中）"""
+    return isinstance(sink, LocalSink) and not sink.directory
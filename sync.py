@@ -0,0 +1,489 @@
+import os
+import sys
+import json
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PyQt5.QtCore import Qt
+
+from bilibili_api import BilibiliAPI
+from config import load_config
+from download import DownloadWorker, stream_resolver
+from danmaku import DanmakuWorker
+from prefetch import MetadataPrefetcher
+from scheduler import MB, get_scheduler, estimate_stream_bytes
+from tracing import create_tracer
+from planner import estimate_sizes, peak_disk_usage, get_disk_budget
+from process import merge_video_audio, concat_parts
+from sinks import create_sink, deliver_outputs, is_passthrough
+
+
+def iter_pages(fetch_page):
+    """逐页请求列表，fetch_page(页码) 返回 (条目列表, 是否还有下一页)"""
+    page_number = 1
+    while True:
+        items, has_more = fetch_page(page_number)
+        for item in items:
+            yield item
+        if not items or not has_more:
+            return
+        page_number += 1
+
+
+def iter_uploader(api, mid, page_size=30):
+    """按发布时间从新到旧遍历UP主的投稿"""
+    def fetch_page(page_number):
+        data, error = api.get_json(
+            "https://api.bilibili.com/x/space/wbi/arc/search",
+            {'mid': mid, 'pn': page_number, 'ps': page_size, 'order': 'pubdate'},
+            wbi=True
+        )
+        if error:
+            raise Exception(f"获取UP主{mid}投稿失败: {error}")
+        vlist = data['list']['vlist'] or []
+        items = [{'bvid': v['bvid'], 'time': v['created'], 'title': v['title']} for v in vlist]
+        return items, page_number * page_size < data['page']['count']
+    return iter_pages(fetch_page)
+
+
+def iter_favorite(api, media_id, page_size=20):
+    """按收藏时间从新到旧遍历收藏夹"""
+    def fetch_page(page_number):
+        data, error = api.get_json(
+            "https://api.bilibili.com/x/v3/fav/resource/list",
+            {'media_id': media_id, 'pn': page_number, 'ps': page_size, 'order': 'mtime'}
+        )
+        if error:
+            raise Exception(f"获取收藏夹{media_id}失败: {error}")
+        medias = data.get('medias') or []
+        items = [{'bvid': m['bvid'], 'time': m['fav_time'], 'title': m['title']} for m in medias]
+        return items, data.get('has_more', False)
+    return iter_pages(fetch_page)
+
+
+def iter_collection(api, mid, season_id, page_size=30):
+    """按合集内的排列顺序遍历合集，顺序由UP主编排，不一定是发布时间"""
+    def fetch_page(page_number):
+        data, error = api.get_json(
+            "https://api.bilibili.com/x/polymer/web-space/seasons_archives_list",
+            {'mid': mid, 'season_id': season_id, 'page_num': page_number,
+             'page_size': page_size, 'sort_reverse': 'true'}
+        )
+        if error:
+            raise Exception(f"获取合集{season_id}失败: {error}")
+        archives = data.get('archives') or []
+        items = [{'bvid': a['bvid'], 'time': a['pubdate'], 'title': a['title']} for a in archives]
+        return items, page_number * page_size < data['page']['total']
+    return iter_pages(fetch_page)
+
+
+def iter_source(api, source):
+    """根据 'uploader:mid'、'favorite:media_id'、'collection:mid:season_id' 遍历订阅源"""
+    kind, *args = source.split(':')
+    if kind == 'uploader':
+        return iter_uploader(api, *args)
+    elif kind == 'favorite':
+        return iter_favorite(api, *args)
+    elif kind == 'collection':
+        return iter_collection(api, *args)
+    raise ValueError(f"未知的订阅源类型: {kind}")
+
+
+def is_ordered(source):
+    """订阅源是否按时间从新到旧排列；合集按UP主编排的顺序排列，不能用时间高水位"""
+    return not source.startswith('collection:')
+
+
+class SyncState:
+    """各订阅源的同步位置（高水位），保存在JSON文件中
+
+    按时间排列的订阅源记录高水位 {'time', 'bvids'}；合集记录所有已同步的bvid {'seen'}。
+    """
+
+    def __init__(self, path=None):
+        self.path = path or load_config()['sync']['state_file']
+        self.marks = {}
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.marks = json.load(f)
+        except Exception as e:
+            print(f"加载同步记录失败: {str(e)}")
+
+    def save(self):
+        """保存同步记录，先写临时文件再替换，写到一半被中断时不会损坏原记录"""
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.marks, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.path)
+
+    def advance_all(self, sources, new_items, outcomes):
+        """按已结束的下载推进各订阅源的同步记录，outcomes 为 {bvid: 是否成功}
+
+        按时间排列的订阅源从旧到新推进高水位，遇到失败或还没下载完的条目就停下，下次同步会重试；
+        合集按bvid记录，失败的条目不影响记录其他成功的条目。
+        """
+        for source in sources:
+            items = sorted(
+                (item for entries in new_items.values() for s, item in entries if s == source),
+                key=lambda item: item['time']
+            )
+            for item in items:
+                if not outcomes.get(item['bvid']):
+                    if is_ordered(source):
+                        break
+                    continue
+                self.advance(source, item)
+
+    def iter_new(self, source, items):
+        """只产出比高水位更新的条目，遇到旧条目即停止，不再请求后续页"""
+        if not is_ordered(source):
+            yield from self.iter_unseen(source, items)
+            return
+        mark = self.marks.get(source, {'time': 0, 'bvids': []})
+        for item in items:
+            if item['time'] < mark['time']:
+                return
+            # 同一时间戳可能有多个条目，用bvid区分是否已同步
+            if item['time'] == mark['time'] and item['bvid'] in mark['bvids']:
+                continue
+            yield item
+
+    def iter_unseen(self, source, items):
+        """产出没有同步过的条目，需要遍历所有页"""
+        mark = self.marks.get(source, {})
+        seen = set(mark.get('seen', []))
+        if 'seen' not in mark:
+            # 旧版本按时间记录的合集：高水位之前的条目当作已同步，转换为bvid记录
+            seen.update(mark.get('bvids', []))
+            legacy_time = mark.get('time', 0)
+        else:
+            legacy_time = 0
+        for item in items:
+            if item['bvid'] in seen:
+                continue
+            if item['time'] < legacy_time:
+                seen.add(item['bvid'])
+                continue
+            yield item
+        self.marks[source] = {'seen': sorted(seen)}
+
+    def advance(self, source, item):
+        """把高水位推进到 item"""
+        if not is_ordered(source):
+            mark = self.marks.setdefault(source, {'seen': []})
+            if item['bvid'] not in mark['seen']:
+                mark['seen'].append(item['bvid'])
+            return
+        mark = self.marks.get(source, {'time': 0, 'bvids': []})
+        if item['time'] > mark['time']:
+            mark = {'time': item['time'], 'bvids': [item['bvid']]}
+        elif item['time'] == mark['time'] and item['bvid'] not in mark['bvids']:
+            mark['bvids'].append(item['bvid'])
+        self.marks[source] = mark
+
+
+class ScheduleUpdater(threading.Thread):
+    """同步期间定时按剩余下载量调整全局限速，对应界面中的 refresh_schedule
+
+    不在下载时段内时调度器会暂停限速器，正在传输的流也会停下来等待。
+    """
+
+    def __init__(self, log=print, interval=30):
+        super().__init__(daemon=True)
+        self.log = log
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.estimated = {}  # bvid -> 估算的总字节数
+        self.downloaded = {}  # bvid -> {流名称: 已下载字节数}
+        self.message = None
+        self.stopped = threading.Event()
+
+    def add(self, result):
+        """登记一个待下载视频的估算大小"""
+        if result['error']:
+            return
+        size = sum(
+            estimate_stream_bytes(urls[kind], urls['duration'])
+            for urls in result['urls'].values() for kind in ('video_stream', 'audio_stream')
+        )
+        with self.lock:
+            self.estimated[result['bvid']] = size
+            self.downloaded[result['bvid']] = {}
+
+    def progress(self, bvid, name, downloaded):
+        with self.lock:
+            if bvid in self.downloaded:
+                self.downloaded[bvid][name] = downloaded
+
+    def finish(self, bvid):
+        with self.lock:
+            self.estimated.pop(bvid, None)
+            self.downloaded.pop(bvid, None)
+
+    def remaining_bytes(self):
+        with self.lock:
+            return sum(
+                max(size - sum(self.downloaded[bvid].values()), 0)
+                for bvid, size in self.estimated.items()
+            )
+
+    def refresh(self):
+        _, message = get_scheduler().update(self.remaining_bytes())
+        if message and message != self.message:
+            self.log(message)
+        self.message = message
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.refresh()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def download_streams(api, result, page, urls, paths, log=print, updater=None):
+    """下载一个分P的视频流和音频流，返回是否成功"""
+    # 不启动线程，直接在当前线程中运行下载
+    # 预取的地址可能等到下载时已经过期，下载时按需刷新
+    results = []
+    for url, path, desc, kind in ((urls['video_url'], paths['video_path'], "视频流", 'video_stream'),
+                                  (urls['audio_url'], paths['audio_path'], "音频流", 'audio_stream')):
+        resolver = stream_resolver(api, result['info']['aid'], page['cid'], result['quality'], kind, urls[kind])
+        worker = DownloadWorker(url, path, desc, resolver)
+        worker.download_completed.connect(lambda success, desc: results.append(success))
+        if updater:
+            # 按保存路径区分各分P的流，供调度器计算剩余量
+            worker.stats_updated.connect(
+                lambda desc, downloaded, total, speed, path=path: updater.progress(result['bvid'], path, downloaded)
+            )
+        worker.run()
+    if not all(results):
+        log(f"{result['bvid']} P{page['page']} 下载失败")
+        return False
+    return True
+
+
+def start_danmaku(api, result, sources, output_path, log=print, part_files=None):
+    """在后台线程中导出弹幕和字幕，和视频流下载同时进行；未开启时返回None"""
+    if not load_config()['danmaku']['enabled']:
+        return None
+    worker = DanmakuWorker(api, result['info']['aid'], sources, output_path, part_files=part_files)
+    # 弹幕在单独的线程中导出，当前线程没有事件循环，信号要直接调用，否则提示会丢失
+    worker.status_updated.connect(lambda message: log(f"{result['bvid']}: {message}"), Qt.DirectConnection)
+    thread = threading.Thread(target=worker.run, daemon=True)
+    thread.start()
+    return thread
+
+
+def download_page(api, result, page, urls, paths, log=print, updater=None):
+    """下载并合并一个分P，返回是否成功"""
+    danmaku = start_danmaku(api, result, [(page['cid'], page['duration'], 0)], paths['output_path'], log)
+    try:
+        if not download_streams(api, result, page, urls, paths, log, updater):
+            return False
+        success, message = merge_video_audio(paths['video_path'], paths['audio_path'], paths['output_path'])
+        log(f"{result['bvid']} P{page['page']}: {message}")
+        return success
+    finally:
+        if danmaku:
+            danmaku.join()
+
+
+def download_series(api, result, page_paths, output_path, log=print, updater=None):
+    """按顺序下载所有分P，再一次流复制拼接成带章节的文件，返回是否成功"""
+    info = result['info']
+    # 弹幕按分P时长依次偏移，和章节对齐；偏移按已下载分P文件的实际时长计算，
+    # 所以和界面中一样，随最后一个分P一起导出
+    sources = []
+    offset = 0
+    for page in info['pages']:
+        sources.append((page['cid'], page['duration'], offset))
+        offset += page['duration']
+    danmaku = None
+    try:
+        for page, paths in zip(info['pages'], page_paths):
+            if page is info['pages'][-1]:
+                danmaku = start_danmaku(api, result, sources, output_path, log,
+                                        part_files=[part['video_path'] for part in page_paths])
+            if not download_streams(api, result, page, result['urls'][page['cid']], paths, log, updater):
+                return False
+        success, message = concat_parts(
+            [(paths['video_path'], paths['audio_path'], page['part'], page['duration'])
+             for page, paths in zip(info['pages'], page_paths)],
+            output_path
+        )
+        log(f"{result['bvid']}: {message}")
+        return success
+    finally:
+        if danmaku:
+            danmaku.join()
+
+
+def deliver(sink, output_path, label, log=print):
+    """交付到配置的输出位置，返回是否成功"""
+    if sink and not is_passthrough(sink):
+        locations, error = deliver_outputs(sink, output_path)
+        if error:
+            log(f"{label}: {error}")
+            return False
+        log(f"{label} 已保存至: {', '.join(locations)}")
+    return True
+
+
+def reserve_disk(api, key, download_path, all_urls, label, log=print):
+    """磁盘空间不够时等其他下载结束，仍然不够时返回False"""
+    peak_size = peak_disk_usage(sum(sum(estimate_sizes(api, urls).values()) for urls in all_urls))
+    if not get_disk_budget().wait_reserve(key, download_path, peak_size):
+        log(f"{label}: 磁盘空间不足，需要约 {peak_size / MB:.0f}MB")
+        return False
+    return True
+
+
+def download_resolved(api, result, download_path, sink=None, log=print, concat=False, updater=None):
+    """下载预取结果中的所有分P，返回是否全部成功
+
+    concat 为True时多P视频拼接成一个带章节的文件，不单独保存每个分P。
+    updater 为 ScheduleUpdater 时汇报下载进度，用于按截止时间调整限速。
+    """
+    # 每个视频一条时间线，当前线程中创建的下载线程和合并都记录到这里
+    tracer = create_tracer(result['bvid'])
+    tracer.begin()
+    try:
+        with tracer.activate():
+            return download_video(api, result, download_path, sink, log, concat, updater)
+    finally:
+        if updater:
+            updater.finish(result['bvid'])
+        trace_path = tracer.finish()
+        if trace_path:
+            log(f"{result['bvid']} 时间线已保存: {trace_path}")
+
+
+def download_video(api, result, download_path, sink=None, log=print, concat=False, updater=None):
+    """download_resolved 的实际下载过程"""
+    if result['error']:
+        log(f"{result['bvid']} 解析失败: {result['error']}")
+        return False
+
+    info = result['info']
+    title = info['title'].replace(" ", "_")
+    if concat and len(info['pages']) > 1:
+        page_paths = []
+        for page in info['pages']:
+            part_paths, error = api.prepare_download_paths(download_path, f"{title}_P{page['page']}")
+            if error:
+                log(error)
+                return False
+            page_paths.append(part_paths)
+        paths, error = api.prepare_download_paths(download_path, title)
+        if error:
+            log(error)
+            return False
+
+        # 不在下载时段内时等待
+        get_scheduler().wait_until_open()
+        all_urls = [result['urls'][page['cid']] for page in info['pages']]
+        if not reserve_disk(api, paths['output_path'], download_path, all_urls, result['bvid'], log):
+            return False
+        try:
+            success = download_series(api, result, page_paths, paths['output_path'], log, updater)
+        finally:
+            get_disk_budget().release(paths['output_path'])
+        return success and deliver(sink, paths['output_path'], result['bvid'], log)
+
+    for page in info['pages']:
+        urls = result['urls'][page['cid']]
+        page_title = f"{title}_P{page['page']}" if len(info['pages']) > 1 else title
+        label = f"{result['bvid']} P{page['page']}"
+        paths, error = api.prepare_download_paths(download_path, page_title)
+        if error:
+            log(error)
+            return False
+
+        # 不在下载时段内时等待
+        get_scheduler().wait_until_open()
+
+        # 磁盘空间不够时等其他下载结束，仍然不够就放弃这个视频
+        if not reserve_disk(api, paths['output_path'], download_path, [urls], label, log):
+            return False
+        try:
+            success = download_page(api, result, page, urls, paths, log, updater)
+        finally:
+            get_disk_budget().release(paths['output_path'])
+        if not success or not deliver(sink, paths['output_path'], label, log):
+            return False
+    return True
+
+
+def sync_sources(sources, download_path, log=print, concat=False):
+    """增量同步多个订阅源，只下载上次同步之后的新视频"""
+    settings = load_config()['sync']
+    api = BilibiliAPI()
+    state = SyncState()
+    prefetcher = MetadataPrefetcher(api)
+    sink = create_sink()
+
+    # 分页是惰性的，碰到高水位后就不再请求更早的页
+    new_items = {}
+    for source in sources:
+        try:
+            items = list(state.iter_new(source, iter_source(api, source)))
+        except Exception as e:
+            log(str(e))
+            continue
+        log(f"{source}: {len(items)} 个新视频")
+        for item in items:
+            new_items.setdefault(item['bvid'], []).append((source, item))
+
+    # 同步期间定时按剩余量调整限速，不在时段内时暂停传输
+    updater = ScheduleUpdater(log)
+    updater.refresh()
+    updater.start()
+
+    # 每个视频下载结束就推进同步记录并保存，同步中途被中断时已完成的进度不会丢失
+    outcomes = {}
+    lock = threading.Lock()
+
+    def record(bvid, future):
+        try:
+            success = future.result()
+        except Exception as e:
+            log(f"{bvid} 下载出错: {str(e)}")
+            success = False
+        with lock:
+            outcomes[bvid] = success
+            state.advance_all(sources, new_items, outcomes)
+            state.save()
+
+    # 解析完成一个就提交下载一个，解析和下载重叠进行
+    try:
+        with ThreadPoolExecutor(max_workers=settings['download_concurrency']) as executor:
+            for result in prefetcher.prefetch(new_items):
+                updater.add(result)
+                future = executor.submit(download_resolved, api, result, download_path, sink, log, concat, updater)
+                future.add_done_callback(lambda future, bvid=result['bvid']: record(bvid, future))
+    finally:
+        updater.stop()
+        prefetcher.shutdown()
+
+    with lock:
+        # 没有新视频时也保存，旧版合集记录的转换结果不会丢
+        state.save()
+        succeeded = sum(1 for success in outcomes.values() if success)
+    log(f"同步完成：成功 {succeeded}/{len(new_items)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='增量同步UP主投稿、收藏夹或合集')
+    parser.add_argument('sources', nargs='+',
+                        help="订阅源，如 uploader:mid、favorite:media_id、collection:mid:season_id")
+    parser.add_argument('-o', '--output', required=True, help='下载路径')
+    parser.add_argument('--concat', action='store_true', help='多P视频拼接成一个带章节的文件')
+    args = parser.parse_args()
+    sync_sources(args.sources, args.output, concat=args.concat)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
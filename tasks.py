@@ -0,0 +1,84 @@
+import itertools
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+
+class TaskSignals(QObject):
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+
+class Task(QRunnable):
+    """在线程池中执行的一次函数调用"""
+
+    def __init__(self, func, args, kwargs):
+        super().__init__()
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = TaskSignals()
+        self.cancelled = False
+
+    def cancel(self):
+        """取消任务：未开始的不再执行，已开始的结果会被丢弃"""
+        self.cancelled = True
+
+    def run(self):
+        # 取消的任务也要发出信号，由 TaskRunner 丢弃结果并释放引用
+        if self.cancelled:
+            self.signals.finished.emit(None)
+            return
+        try:
+            result = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+            return
+        self.signals.finished.emit(result)
+
+
+class TaskRunner(QObject):
+    """把耗时调用放到后台线程执行，结果回到界面线程处理
+
+    同一个 key 的新任务会取消旧任务，旧任务的结果即使返回也会被丢弃，
+    适合连续输入时只关心最后一次查询的场景。key 为 None 时任务互不影响。
+    """
+
+    def __init__(self, max_threads=4, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_threads)
+        self.latest = {}  # key -> 最新的任务
+        self.tasks = set()  # 保存引用，直到结果送达
+        self.counter = itertools.count()
+
+    def submit(self, key, func, *args, on_done=None, on_error=None, **kwargs):
+        """提交任务，返回任务对象"""
+        if key is None:
+            key = ('unique', next(self.counter))
+        self.cancel(key)
+
+        task = Task(func, args, kwargs)
+        task.setAutoDelete(False)
+        task.signals.finished.connect(lambda result: self.deliver(key, task, on_done, result))
+        task.signals.failed.connect(lambda message: self.deliver(key, task, on_error, message))
+        self.latest[key] = task
+        self.tasks.add(task)
+        self.pool.start(task)
+        return task
+
+    def deliver(self, key, task, callback, value):
+        """在界面线程中分发结果，过期任务的结果直接丢弃"""
+        self.tasks.discard(task)
+        if task.cancelled or self.latest.get(key) is not task:
+            return
+        del self.latest[key]
+        if callback:
+            callback(value)
+
+    def cancel(self, key):
+        """取消 key 对应的任务"""
+        task = self.latest.pop(key, None)
+        if task:
+            task.cancel()
+            # 尚未开始的任务直接从队列移除
+            if self.pool.tryTake(task):
+                self.tasks.discard(task)
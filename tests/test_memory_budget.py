@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import datetime
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('PyQt5')
+pytest.importorskip('requests')
+
+from PyQt5.QtCore import Qt
+
+import memory
+import writer
+from download import DownloadWorker
+
+STREAMS = 100
+STREAM_SIZE = 3 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+BUDGET = 8 * 1024 * 1024
+# 线程栈、写入线程、解释器对象等缓冲区之外的开销
+OVERHEAD = 16 * 1024 * 1024
+PATTERN = b'\x5a' * CHUNK_SIZE
+
+
+def current_rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class FakeRaw:
+    def __init__(self, size):
+        self.remaining = size
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        memoryview(buffer)[:size] = PATTERN[:size]
+        self.remaining -= size
+        return size
+
+
+class FakeResponse:
+    """不联网的响应，按块产出固定内容"""
+
+    status_code = 200
+    elapsed = datetime.timedelta(milliseconds=1)
+
+    def __init__(self, size):
+        self.headers = {'content-length': str(size)}
+        self.raw = FakeRaw(size)
+
+    def close(self):
+        pass
+
+
+class PeakSampler(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = current_rss()
+        self.running = True
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, current_rss())
+            time.sleep(0.005)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        return max(self.peak, current_rss())
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/statm'), reason='需要 /proc 读取RSS')
+def test_peak_rss_stays_within_budget(tmp_path, monkeypatch):
+    buffers_per_stream = 16 * 2 + 1
+    pool = memory.BufferPool(CHUNK_SIZE, BUDGET, buffers_per_stream)
+    monkeypatch.setattr(memory, '_buffer_pool', pool)
+    # 磁盘比网络慢，写入队列会被填满，这是内存占用最高的情况
+    write_batch = writer.BufferedFileWriter.write_batch
+
+    def slow_write_batch(self, batch):
+        time.sleep(0.01)
+        write_batch(self, batch)
+    monkeypatch.setattr(writer.BufferedFileWriter, 'write_batch', slow_write_batch)
+
+    workers = []
+    results = []
+    for index in range(STREAMS):
+        worker = DownloadWorker(f"https://example.com/{index}.m4s", str(tmp_path / f"{index}.m4s"), f"流{index}")
+        worker.get_response = lambda url: FakeResponse(STREAM_SIZE)
+        # 下载在普通线程中运行，没有事件循环，必须直接调用，否则信号会排队到主线程
+        worker.download_completed.connect(lambda success, desc: results.append(success), Qt.DirectConnection)
+        workers.append(worker)
+
+    baseline = current_rss()
+    sampler = PeakSampler()
+    sampler.start()
+    threads = [threading.Thread(target=worker.run) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    peak = sampler.stop()
+
+    assert results == [True] * STREAMS
+    assert all(os.path.getsize(tmp_path / f"{index}.m4s") == STREAM_SIZE for index in range(STREAMS))
+    # 缓冲区只在预算内分配，100个流不会各自分配一份
+    assert pool.allocated * CHUNK_SIZE <= BUDGET
+    assert peak - baseline < BUDGET + OVERHEAD
@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import time
+import threading
+import functools
+from collections import Counter
+from contextlib import contextmanager
+
+from config import load_config
+
+_local = threading.local()
+
+
+class Tracer:
+    """记录一个任务的时间线，保存为 Chrome trace 格式的JSON
+
+    生成的文件可以用 chrome://tracing 或 https://ui.perfetto.dev 打开。
+    每个事件带线程号，同一任务中视频流、音频流、合并等线程各占一行。
+    """
+
+    enabled = True
+
+    def __init__(self, name, settings=None):
+        self.settings = settings or load_config()['tracing']
+        self.name = "".join(c for c in name if c.isalnum() or c in ('-', '_'))
+        self.lock = threading.Lock()
+        self.events = []
+        self.threads = {}  # 线程号 -> 线程名
+        self.started = time.strftime("%Y%m%d_%H%M%S")
+        self.timer = None
+        self.profiler = None
+
+    @staticmethod
+    def now():
+        return time.perf_counter()
+
+    def register_thread(self):
+        tid = threading.get_ident()
+        if tid not in self.threads:
+            with self.lock:
+                self.threads[tid] = threading.current_thread().name
+        return tid
+
+    def complete(self, name, start, category='download', **args):
+        """记录一个从 start（perf_counter 时间）到现在的区间"""
+        end = self.now()
+        event = {
+            'name': name, 'cat': category, 'ph': 'X',
+            'ts': start * 1e6, 'dur': (end - start) * 1e6,
+            'pid': os.getpid(), 'tid': self.register_thread(),
+        }
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+
+    def instant(self, name, category='download', **args):
+        """记录一个时间点（重连、刷新地址等）"""
+        event = {
+            'name': name, 'cat': category, 'ph': 'i', 's': 't',
+            'ts': self.now() * 1e6, 'pid': os.getpid(), 'tid': self.register_thread(),
+        }
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, category='download', **args):
+        """记录代码块的耗时，args 可以在代码块中继续补充"""
+        start = self.now()
+        try:
+            yield args
+        except Exception as e:
+            args['error'] = str(e)
+            raise
+        finally:
+            self.complete(name, start, category, **args)
+
+    @contextmanager
+    def activate(self):
+        """在当前线程中设为当前任务，带 @traced 的函数会记录到这个任务"""
+        previous = getattr(_local, 'tracer', None)
+        _local.tracer = self
+        try:
+            yield self
+        finally:
+            _local.tracer = previous
+
+    def begin(self):
+        """任务开始执行；配置了阈值时，超时未完成的任务会挂上采样分析器"""
+        seconds = self.settings['profile_after_seconds']
+        if seconds and self.timer is None:
+            self.timer = threading.Timer(seconds, self.attach_profiler)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def attach_profiler(self):
+        # 在定时器线程中执行，不记录事件，避免定时器线程本身被采样
+        self.profiler = SamplingProfiler(self.threads, self.settings['profile_interval_ms'] / 1000)
+        self.profiler.start()
+
+    def path(self, extension):
+        return os.path.join(self.settings['directory'], f"{self.name}_{self.started}.{extension}")
+
+    def finish(self):
+        """任务结束，写出时间线文件，返回文件路径"""
+        if self.timer:
+            self.timer.cancel()
+        os.makedirs(self.settings['directory'], exist_ok=True)
+        if self.profiler:
+            self.profiler.stop()
+            self.profiler.save(self.path('folded'))
+
+        with self.lock:
+            events = [
+                {'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+                for tid, name in self.threads.items()
+            ] + self.events
+        trace_path = self.path('json')
+        other = {'job': self.name, 'started': self.started}
+        if self.profiler:
+            other['profile'] = os.path.basename(self.path('folded'))
+        with open(trace_path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': other}, f, ensure_ascii=False)
+        return trace_path
+
+
+class NullTracer:
+    """未开启追踪时使用，所有操作都不做任何事"""
+
+    enabled = False
+
+    @staticmethod
+    def now():
+        return time.perf_counter()
+
+    def complete(self, name, start, category='download', **args):
+        pass
+
+    def instant(self, name, category='download', **args):
+        pass
+
+    @contextmanager
+    def span(self, name, category='download', **args):
+        yield args
+
+    @contextmanager
+    def activate(self):
+        yield self
+
+    def begin(self):
+        pass
+
+    def finish(self):
+        return None
+
+
+NULL_TRACER = NullTracer()
+
+
+def create_tracer(name):
+    """按配置创建任务的追踪器，未开启时返回 NULL_TRACER"""
+    settings = load_config()['tracing']
+    return Tracer(name, settings) if settings['enabled'] else NULL_TRACER
+
+
+def current_tracer():
+    """当前线程正在执行的任务的追踪器"""
+    return getattr(_local, 'tracer', None) or NULL_TRACER
+
+
+def traced(name, category='api'):
+    """装饰器：把函数调用记录到当前线程的任务时间线中"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with current_tracer().span(name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SamplingProfiler:
+    """定时采样指定线程的调用栈，输出 collapsed stack 格式
+
+    输出文件每行是 "函数;函数;... 次数"，可以用 flamegraph.pl 或 speedscope 生成火焰图。
+    """
+
+    def __init__(self, threads, interval=0.01):
+        self.threads = threads
+        self.interval = interval
+        self.samples = Counter()
+        self.running = threading.Event()
+        self.thread = threading.Thread(target=self.sample_loop, name='SamplingProfiler', daemon=True)
+
+    def start(self):
+        self.running.set()
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def sample_loop(self):
+        while self.running.is_set():
+            frames = sys._current_frames()
+            for tid, name in list(self.threads.items()):
+                frame = frames.get(tid)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(name)
+                self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
@@ -1,8 +1,8 @@
 from PyQt5.QtWidgets import (QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
                              QLabel, QLineEdit, QPushButton, QComboBox,
-                             QProgressBar, QTextEdit, QFrame)
+                             QTextEdit, QFrame, QCheckBox)
 from PyQt5.QtCore import pyqtSignal, Qt
-from PyQt5.QtGui import QPixmap, QFont, QColor, QPalette
+from download_table import DownloadManagerView
 
 
 class StyleSheet:
@@ -98,7 +98,7 @@ class BilibiliDownloaderUI(QMainWindow):
 
     def initUI(self):
         self.setWindowTitle('Bilibili Video Downloader')
-        self.setGeometry(100, 100, 800, 700)
+        self.setGeometry(100, 100, 900, 800)
         self.setStyleSheet(StyleSheet.MAIN_STYLE)
 
         # 创建中心部件
@@ -164,6 +164,22 @@ class BilibiliDownloaderUI(QMainWindow):
 
         options_frame.layout.addLayout(options_layout)
 
+        # 多P视频下载全部分P并拼接成一个带章节的文件
+        self.concat_checkbox = QCheckBox('合并全部分P')
+        options_frame.layout.addWidget(self.concat_checkbox)
+
+        # 片段截取（留空则下载完整视频）
+        clip_layout = QHBoxLayout()
+        clip_label = QLabel('截取片段:')
+        self.clip_start_input = QLineEdit()
+        self.clip_start_input.setPlaceholderText("开始时间，如 1:30")
+        self.clip_end_input = QLineEdit()
+        self.clip_end_input.setPlaceholderText("结束时间，如 2:00")
+        clip_layout.addWidget(clip_label)
+        clip_layout.addWidget(self.clip_start_input)
+        clip_layout.addWidget(self.clip_end_input)
+        options_frame.layout.addLayout(clip_layout)
+
         # 下载路径
         path_layout = QHBoxLayout()
         path_label = QLabel('下载路径:')
@@ -187,24 +203,27 @@ class BilibiliDownloaderUI(QMainWindow):
                 background-color: #c0392b;
             }
         """)
-        options_frame.layout.addWidget(self.download_btn, alignment=Qt.AlignCenter)
+        self.estimate_btn = QPushButton('排期预估')
+        button_layout = QHBoxLayout()
+        button_layout.addStretch()
+        button_layout.addWidget(self.download_btn)
+        button_layout.addWidget(self.estimate_btn)
+        button_layout.addStretch()
+        options_frame.layout.addLayout(button_layout)
 
         # 进度显示区域
         progress_frame = CustomFrame("下载进度")
         main_layout.addWidget(progress_frame)
 
-        # 进度条
-        self.video_progress = QProgressBar()
-        self.audio_progress = QProgressBar()
-        progress_frame.layout.addWidget(QLabel('视频下载进度:'))
-        progress_frame.layout.addWidget(self.video_progress)
-        progress_frame.layout.addWidget(QLabel('音频下载进度:'))
-        progress_frame.layout.addWidget(self.audio_progress)
+        # 任务列表，每个下载任务一行
+        self.download_table = DownloadManagerView()
+        progress_frame.layout.addWidget(self.download_table)
 
-        # 状态显示
+        # 状态显示，只保留最近的日志
         self.status_text = QTextEdit()
         self.status_text.setReadOnly(True)
         self.status_text.setMaximumHeight(100)
+        self.status_text.document().setMaximumBlockCount(1000)
         progress_frame.layout.addWidget(self.status_text)
 
 
@@ -214,8 +233,6 @@ class LoginDialog(QWidget):
     def __init__(self):
         super().__init__()
         self.initUI()
-        self.qr_key = None
-        self.check_timer = None
 
     def initUI(self):
         self.setWindowTitle('哔哩哔哩扫码登录')
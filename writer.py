@@ -0,0 +1,104 @@
+import os
+import time
+import queue
+import threading
+
+
+class BufferedFileWriter(threading.Thread):
+    """独立的磁盘写入线程
+
+    下载线程把数据块放进有界队列，写入线程批量取出写盘。
+    队列满时 put 会阻塞（背压），阻塞时间计入 stalled_time。
+    """
+
+    def __init__(self, file, max_queue=16, batch_size=4 * 1024 * 1024, on_written=None):
+        super().__init__(daemon=True)
+        self.file = file
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.on_written = on_written  # 每个数据块写完后的回调，用于归还缓冲区
+        self.error = None
+
+        # 统计信息
+        self.bytes_written = 0
+        self.batches = 0
+        self.max_depth = 0
+        self.stalled_time = 0.0  # 下载线程因队列满而等待的时间
+        self.write_time = 0.0  # 写入线程实际写盘的时间
+        self.start()
+
+    def put(self, chunk):
+        """提交一个数据块，队列满时阻塞"""
+        if self.error:
+            if self.on_written:
+                self.on_written(chunk)
+            raise IOError(self.error)
+        try:
+            self.queue.put_nowait(chunk)
+        except queue.Full:
+            wait_start = time.monotonic()
+            self.queue.put(chunk)
+            self.stalled_time += time.monotonic() - wait_start
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def run(self):
+        finished = False
+        while not finished:
+            batch = [self.queue.get()]
+            batch_bytes = len(batch[0]) if batch[0] is not None else 0
+            # 尽量凑够一批再写，减少系统调用次数
+            while batch[-1] is not None and batch_bytes < self.batch_size:
+                try:
+                    chunk = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(chunk)
+                if chunk is not None:
+                    batch_bytes += len(chunk)
+            if batch[-1] is None:
+                finished = True
+                batch.pop()
+
+            if batch and not self.error:
+                try:
+                    write_start = time.monotonic()
+                    self.write_batch(batch)
+                    self.write_time += time.monotonic() - write_start
+                    self.bytes_written += batch_bytes
+                    self.batches += 1
+                except Exception as e:
+                    self.error = str(e)
+            if self.on_written:
+                for chunk in batch:
+                    self.on_written(chunk)
+
+    def write_batch(self, batch):
+        """写入一批数据块，不拼接成一整块，避免在缓冲区池之外再复制一份"""
+        if len(batch) == 1 or not hasattr(os, 'writev'):
+            self.file.writelines(batch)
+            return
+        # 一次系统调用写入多个缓冲区，先把文件对象里缓存的数据写出去
+        self.file.flush()
+        fd = self.file.fileno()
+        pending = list(batch)
+        while pending:
+            written = os.writev(fd, pending)
+            # 只写入了一部分时，去掉已写完的块，从剩余位置继续
+            while pending and written >= len(pending[0]):
+                written -= len(pending[0])
+                pending.pop(0)
+            if written:
+                pending[0] = pending[0][written:]
+
+    def close(self):
+        """等待队列写完，写入出错时抛出IOError"""
+        self.queue.put(None)
+        self.join()
+        self.file.flush()
+        if self.error:
+            raise IOError(self.error)
+
+    def summary(self):
+        """统计信息摘要"""
+        return (f"写入{self.batches}批，队列最大深度{self.max_depth}，"
+                f"等待磁盘{self.stalled_time:.2f}s，写盘耗时{self.write_time:.2f}s")